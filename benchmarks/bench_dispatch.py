@@ -0,0 +1,83 @@
+"""
+Микробенчмарк накладных расходов на разбор апдейта в handle_message:
+прежняя цепочка сравнений с пересборкой клавиатуры и промптов против реестра режимов.
+
+Запуск:
+    python benchmarks/bench_dispatch.py --number 200000
+"""
+import argparse
+import os
+import sys
+import timeit
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "0:bench")
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from telegram import KeyboardButton, ReplyKeyboardMarkup  # noqa: E402
+
+import bot  # noqa: E402
+
+
+def legacy_build_keyboard():
+    keyboard = [
+        [KeyboardButton("📈 SEO"), KeyboardButton("🌍 Изображение")],
+        [KeyboardButton("💁‍♀️ Помощница"), KeyboardButton("🧘‍♀️ Олеся")],
+        [KeyboardButton("💬 Психолог"), KeyboardButton("🔮 Астролог")],
+        [KeyboardButton("🔙 Назад в главное меню")]
+    ]
+    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+
+
+def legacy_dispatch(text, mode):
+    """Та же работа, что делал прежний handle_message до вызова OpenAI."""
+    if text == "🔙 Назад в главное меню":
+        return "default", legacy_build_keyboard()
+    for button, key in (
+        ("📈 SEO", "seo"), ("💁‍♀️ Помощница", "assistant"), ("🧘‍♀️ Олеся", "olesya"),
+        ("🌍 Изображение", "image"), ("💬 Психолог", "psychologist"), ("🔮 Астролог", "astrologer"),
+    ):
+        if text == button:
+            return key, None
+    if mode in ("olesya", "assistant", "seo", "image"):
+        return mode, None
+    system_prompts = {
+        "default": "Ты — дружелюбный и полезный ассистент. Используй HTML-теги для форматирования: <b> для жирного, <i> для курсива.",
+        "psychologist": "Ты — эмпатичный психолог. Используй HTML-теги для форматирования: <b> для акцентов, <i> для мягких выделений.",
+        "astrologer": "Ты — опытный астролог. Используй HTML-теги для форматирования: <b> для важных терминов, <i> для названий."
+    }
+    return system_prompts.get(mode, system_prompts["default"]), legacy_build_keyboard()
+
+
+def registry_dispatch(text, mode):
+    selected, switched = bot.resolve_mode(text, mode)
+    return selected.system_prompt, bot.MAIN_KEYBOARD
+
+
+# Смесь: обычные сообщения в чат-режимах и нажатия кнопок меню
+SAMPLES = [
+    ("Привет, как дела?", "default"),
+    ("Что ждёт Льва на этой неделе?", "astrologer"),
+    ("🔙 Назад в главное меню", "seo"),
+    ("платье, лето, хлопок", "seo"),
+    ("🔮 Астролог", "default"),
+    ("Мне грустно", "psychologist"),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", type=int, default=200000)
+    args = parser.parse_args()
+
+    for name, func in (("цепочка if", legacy_dispatch), ("реестр", registry_dispatch)):
+        def run():
+            for text, mode in SAMPLES:
+                func(text, mode)
+        best = min(timeit.repeat(run, number=args.number // len(SAMPLES), repeat=5))
+        per_update = best / (args.number // len(SAMPLES) * len(SAMPLES))
+        print(f"{name:<12} {per_update * 1e6:8.3f} мкс на апдейт")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+Время запуска ensure_ffmpeg: холодный старт (скачивание и распаковка), тёплый (бинарник
+в общем кэше) и горячий (бинарник уже в BIN_DIR), а также прежний путь с чтением архива в память.
+
+Архив генерируется локально (ffmpeg-заглушка и «тяжёлые» файлы после неё), раздаётся
+локальным HTTP-сервером вместе с .md5. Сеть и настоящий ffmpeg не нужны.
+Тёплый старт проверяется и при недоступном сервере контрольной суммы.
+
+Запуск:
+    python benchmarks/bench_ffmpeg_bootstrap.py --binary-mb 70 --tail-mb 40
+"""
+import argparse
+import asyncio
+import hashlib
+import io
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "0:bench")
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import aiohttp  # noqa: E402
+from aiohttp import web  # noqa: E402
+
+import bot  # noqa: E402
+
+
+def make_archive(path, binary_mb, tail_mb):
+    """Повторяет структуру статического билда: каталог с ffmpeg, за ним другие крупные файлы."""
+    def add(tar, name, size):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mode = 0o755
+        tar.addfile(info, io.BytesIO(os.urandom(size)))
+
+    with tarfile.open(path, "w:xz", preset=0) as tar:
+        add(tar, "ffmpeg-7.0-amd64-static/ffmpeg", binary_mb << 20)
+        add(tar, "ffmpeg-7.0-amd64-static/ffprobe", tail_mb << 20)
+    with open(path, "rb") as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+async def legacy_ensure_ffmpeg(url, bin_dir):
+    """Прежняя реализация: весь архив в память, затем getmembers()."""
+    archive_path = os.path.join(bin_dir, "ffmpeg.tar.xz")
+    async with aiohttp.ClientSession() as session:
+        async with session.get(url) as resp:
+            with open(archive_path, "wb") as f:
+                f.write(await resp.read())
+    with tarfile.open(archive_path, "r:xz") as tar:
+        for member in tar.getmembers():
+            if member.name.endswith('/ffmpeg'):
+                member.name = os.path.basename(member.name)
+                tar.extract(member, path=bin_dir)
+                break
+    os.remove(archive_path)
+
+
+async def timed(coroutine):
+    started = time.perf_counter()
+    await coroutine
+    return time.perf_counter() - started
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--binary-mb", type=int, default=70)
+    parser.add_argument("--tail-mb", type=int, default=40)
+    parser.add_argument("--port", type=int, default=18083)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="ffmpeg-bench-")
+    try:
+        archive = os.path.join(workdir, "ffmpeg-release-amd64-static.tar.xz")
+        md5 = make_archive(archive, args.binary_mb, args.tail_mb)
+        checksum = {"value": md5}
+
+        async def serve_archive(request):
+            return web.FileResponse(archive)
+
+        async def serve_md5(request):
+            return web.Response(text=f"{checksum['value']}  ffmpeg-release-amd64-static.tar.xz\n")
+
+        app = web.Application()
+        app.router.add_get("/ffmpeg.tar.xz", serve_archive)
+        app.router.add_get("/ffmpeg.tar.xz.md5", serve_md5)
+        runner = await bot.start_web_server(app, "127.0.0.1", args.port)
+        url = f"http://127.0.0.1:{args.port}/ffmpeg.tar.xz"
+
+        bot.FFMPEG_STATIC_URL = url
+        bot.FFMPEG_MD5 = None
+        bot.FFMPEG_PREFER_SYSTEM = False
+        bot.FFMPEG_CACHE_DIR = os.path.join(workdir, "cache")
+        bot.BIN_DIR = os.path.join(workdir, "bin")
+        bot.FFMPEG_PATH = os.path.join(bot.BIN_DIR, "ffmpeg")
+
+        legacy_dir = os.path.join(workdir, "legacy")
+        os.makedirs(legacy_dir)
+        print(f"Архив: {os.path.getsize(archive) / 2**20:.1f} МБ, ffmpeg {args.binary_mb} МБ + хвост {args.tail_mb} МБ")
+        print(f"прежний путь        {await timed(legacy_ensure_ffmpeg(url, legacy_dir)):7.2f} с")
+        print(f"холодный старт      {await timed(bot.ensure_ffmpeg()):7.2f} с")
+        os.remove(bot.FFMPEG_PATH)
+        print(f"тёплый (кэш)        {await timed(bot.ensure_ffmpeg()):7.2f} с")
+        print(f"горячий (BIN_DIR)   {await timed(bot.ensure_ffmpeg()):7.2f} с")
+
+        # Проверка: тёплый старт без сети берёт последний проверенный билд из кэша
+        os.remove(bot.FFMPEG_PATH)
+        bot.FFMPEG_STATIC_URL = "http://127.0.0.1:9/ffmpeg.tar.xz"
+        print(f"тёплый без сети     {await timed(bot.ensure_ffmpeg()):7.2f} с")
+        assert os.path.isfile(bot.FFMPEG_PATH), "без сети должен использоваться бинарник из кэша"
+        bot.FFMPEG_STATIC_URL = url
+
+        # Проверка: испорченная контрольная сумма не должна попасть в кэш
+        shutil.rmtree(bot.FFMPEG_CACHE_DIR)
+        os.remove(bot.FFMPEG_PATH)
+        checksum["value"] = "0" * 32
+        try:
+            await bot.ensure_ffmpeg()
+        except RuntimeError:
+            assert not os.path.exists(bot.FFMPEG_PATH), "бинарник с неверной суммой не должен устанавливаться"
+            print("неверная md5 отклонена: да")
+        else:
+            raise AssertionError("ensure_ffmpeg принял архив с неверной контрольной суммой")
+
+        await runner.cleanup()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
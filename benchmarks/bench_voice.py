@@ -0,0 +1,108 @@
+"""
+Сравнение обработки голосовых: старый путь через временные файлы
+и новый путь через память/пайпы ffmpeg.
+
+Запуск (нужен ffmpeg, OpenAI не вызывается):
+    python benchmarks/bench_voice.py --seconds 30 --runs 20 --concurrency 4
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "0:bench")
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import bot  # noqa: E402
+
+
+def make_sample_ogg(seconds):
+    """Генерирует OGG/Opus, похожий на голосовое сообщение Telegram."""
+    return subprocess.run(
+        [bot.FFMPEG_PATH, "-hide_banner", "-loglevel", "error",
+         "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}",
+         "-ac", "1", "-c:a", "libopus", "-b:a", "32k", "-f", "ogg", "pipe:1"],
+        check=True, capture_output=True,
+    ).stdout
+
+
+async def file_based(ogg_bytes, workdir, index):
+    """Повторяет прежний handle_voice: ogg на диск, ffmpeg в mp3 на диск, чтение, удаление."""
+    ogg_path = os.path.join(workdir, f"voice_{index}.ogg")
+    mp3_path = os.path.join(workdir, f"voice_{index}.mp3")
+    try:
+        with open(ogg_path, "wb") as f:
+            f.write(ogg_bytes)
+        process = await asyncio.create_subprocess_exec(
+            bot.FFMPEG_PATH, "-i", ogg_path, "-y", mp3_path,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        await process.communicate()
+        with open(mp3_path, "rb") as f:
+            data = f.read()
+        return len(data), len(ogg_bytes) + len(data)
+    finally:
+        for path in (ogg_path, mp3_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+async def pipe_transcode(ogg_bytes, workdir, index):
+    data = await bot.transcode_to_mp3(ogg_bytes)
+    return len(data), 0
+
+
+async def passthrough(ogg_bytes, workdir, index):
+    name, data = await bot.prepare_voice_for_whisper(ogg_bytes)
+    return len(data), 0
+
+
+async def run_variant(name, func, ogg_bytes, runs, concurrency):
+    latencies = []
+    disk_bytes = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        async def one(index):
+            nonlocal disk_bytes
+            async with semaphore:
+                started = time.perf_counter()
+                _, written = await func(ogg_bytes, workdir, index)
+                latencies.append(time.perf_counter() - started)
+                disk_bytes += written
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(runs)))
+        total = time.perf_counter() - started
+
+    latencies.sort()
+    p95 = latencies[max(0, int(len(latencies) * 0.95) - 1)]
+    print(
+        f"{name:<16} p50={statistics.median(latencies) * 1000:8.1f} мс  "
+        f"p95={p95 * 1000:8.1f} мс  всего={total:6.2f} с  "
+        f"запись на диск={disk_bytes / runs / 1024:8.1f} КБ/сообщение"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=int, default=30, help="длительность тестового голосового")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    ogg_bytes = make_sample_ogg(args.seconds)
+    print(f"Голосовое: {args.seconds} с, {len(ogg_bytes) / 1024:.1f} КБ, ffmpeg-процессов не больше {bot.FFMPEG_MAX_PROCS}")
+    await run_variant("файлы (старый)", file_based, ogg_bytes, args.runs, args.concurrency)
+    await run_variant("пайп в mp3", pipe_transcode, ogg_bytes, args.runs, args.concurrency)
+    bot.VOICE_TRANSCODE = False
+    await run_variant("ogg напрямую", passthrough, ogg_bytes, args.runs, args.concurrency)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,175 @@
+"""
+Нагрузочный тест транспорта: long polling против вебхука.
+
+Поднимает локальный фейковый Bot API (getUpdates, sendMessage и т.д.), прогоняет через
+настоящее Application бота N апдейтов с командой /start и считает апдейты в секунду.
+В режиме вебхука апдейты присылает локальный «клиент Telegram» POST-запросами с секретом.
+Затем вебхук заваливается апдейтами при медленном Bot API: лишние должны получать 503,
+а не отбрасываться после подтверждения (bot_updates_dropped_total == 0).
+OpenAI не вызывается.
+
+Запуск:
+    python benchmarks/bench_webhook.py --updates 2000 --chats 200
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "0:bench")
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import aiohttp  # noqa: E402
+
+import bot  # noqa: E402
+from fakes import FakeBotAPI  # noqa: E402
+
+TOKEN = "123456:bench"
+
+
+def make_updates(count, chats):
+    return [
+        {
+            "update_id": i + 1,
+            "message": {
+                "message_id": i + 1, "date": int(time.time()),
+                "chat": {"id": 1000 + i % chats, "type": "private"},
+                "from": {"id": 1000 + i % chats, "is_bot": False, "first_name": "U"},
+                "text": "/start", "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+            },
+        }
+        for i in range(count)
+    ]
+
+
+async def run_polling(api, base_url, updates):
+    application = bot.build_application(token=TOKEN, base_url=base_url)
+    await application.initialize()
+    await application.start()
+    started = time.perf_counter()
+    api.push(updates)
+    await application.updater.start_polling(poll_interval=0, timeout=1)
+    await api.all_sent.wait()
+    elapsed = time.perf_counter() - started
+    await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
+    return elapsed
+
+
+async def run_webhook(api, base_url, updates, port, concurrency):
+    application = bot.build_application(token=TOKEN, base_url=base_url, backlog_limit=None)
+    await application.initialize()
+    await application.start()
+    runner = await bot.start_web_server(bot.build_web_app(application, secret_token="bench-secret"), "127.0.0.1", port)
+    url = f"http://127.0.0.1:{port}{bot.WEBHOOK_PATH}"
+    semaphore = asyncio.Semaphore(concurrency)
+    statuses = []
+
+    async with aiohttp.ClientSession() as session:
+        async def post(update):
+            async with semaphore:
+                async with session.post(url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": "bench-secret"}) as resp:
+                    statuses.append(resp.status)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(post(update) for update in updates))
+        await api.all_sent.wait()
+        elapsed = time.perf_counter() - started
+        async with session.post(url, json=updates[0]) as resp:
+            assert resp.status == 403, "запрос без секрета должен отклоняться"
+        async with session.get(f"http://127.0.0.1:{port}/healthz") as resp:
+            health = await resp.json()
+
+    await runner.cleanup()
+    await application.stop()
+    await application.shutdown()
+    rejected = sum(1 for status in statuses if status != 200)
+    return elapsed, rejected, health
+
+
+async def run_webhook_flood(api, base_url, updates, port, queue_size, backlog_limit):
+    """Все апдейты разом: возвращает (принято, отклонено 503, отброшено процессором)."""
+    application = bot.build_application(token=TOKEN, base_url=base_url, backlog_limit=backlog_limit)
+    await application.initialize()
+    await application.start()
+    web_app = bot.build_web_app(application, secret_token="bench-secret", queue_size=queue_size)
+    runner = await bot.start_web_server(web_app, "127.0.0.1", port)
+    url = f"http://127.0.0.1:{port}{bot.WEBHOOK_PATH}"
+    dropped_before = bot.metrics.counter("bot_updates_dropped_total")
+    statuses = []
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        async def post(update):
+            async with session.post(url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": "bench-secret"}) as resp:
+                statuses.append(resp.status)
+
+        await asyncio.gather(*(post(update) for update in updates))
+        accepted = statuses.count(200)
+        deadline = time.perf_counter() + 60
+        while len(api.sent) < accepted and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+
+    await runner.cleanup()
+    await application.stop()
+    await application.shutdown()
+    dropped = bot.metrics.counter("bot_updates_dropped_total") - dropped_before
+    return accepted, statuses.count(503), dropped
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=40, help="одновременных POST от «Telegram»")
+    parser.add_argument("--api-port", type=int, default=18081)
+    parser.add_argument("--webhook-port", type=int, default=18082)
+    parser.add_argument("--flood-updates", type=int, default=400, help="апдейтов в проверке переполнения")
+    parser.add_argument("--flood-queue", type=int, default=20, help="лимит очереди в проверке переполнения")
+    args = parser.parse_args()
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logging.getLogger("telegram").setLevel(logging.WARNING)
+    logging.getLogger("apscheduler").setLevel(logging.WARNING)
+    updates = make_updates(args.updates, args.chats)
+    for transport in ("polling", "webhook"):
+        api = FakeBotAPI()
+        api.expected = args.updates
+        api_runner = await bot.start_web_server(api.build_app(), "127.0.0.1", args.api_port)
+        base_url = f"http://127.0.0.1:{args.api_port}/bot"
+        try:
+            if transport == "polling":
+                elapsed = await run_polling(api, base_url, updates)
+                extra = ""
+            else:
+                elapsed, rejected, health = await run_webhook(
+                    api, base_url, updates, args.webhook_port, args.concurrency
+                )
+                extra = f"  отклонено={rejected}  healthz={health}"
+        finally:
+            await api_runner.cleanup()
+        print(f"{transport:<8} {args.updates / elapsed:8.1f} апдейтов/с  ({elapsed:.2f} с){extra}")
+
+    # Переполнение: Bot API отвечает медленно, апдейты нескольких чатов приходят одновременно
+    flood = make_updates(args.flood_updates, 4)
+    for backlog_limit in (None, args.flood_queue):
+        api = FakeBotAPI(send_delay=0.02)
+        api_runner = await bot.start_web_server(api.build_app(), "127.0.0.1", args.api_port)
+        base_url = f"http://127.0.0.1:{args.api_port}/bot"
+        try:
+            accepted, shed, dropped = await run_webhook_flood(
+                api, base_url, flood, args.webhook_port, args.flood_queue * 2, backlog_limit
+            )
+        finally:
+            await api_runner.cleanup()
+        print(f"flood    backlog_limit={backlog_limit}  принято={accepted}  503={shed}  отброшено={dropped}")
+        assert shed > 0, "при переполнении вебхук должен отвечать 503"
+        assert dropped == 0, "подтверждённые апдейты не должны отбрасываться"
+        assert len(api.sent) == accepted, "каждый принятый апдейт должен быть обработан"
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,202 @@
+"""
+Локальные заглушки внешних сервисов для бенчмарков: Bot API Telegram и OpenAI.
+Обе поднимаются как aiohttp-приложения и ведут счётчики вызовов.
+"""
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+BOT_INFO = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+# Заглушка 1x1 PNG для ответов генерации картинок
+PNG_BYTES = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360000002000100e221bc330000000049454e44ae426082"
+)
+
+
+class FakeBotAPI:
+    """
+    Минимальный Bot API: отдаёт апдейты через getUpdates, файлы голосовых через /file/,
+    записывает отправленные и отредактированные сообщения (с задержкой `send_delay`, если задана).
+    """
+
+    def __init__(self, voice_bytes=b"OggS" + bytes(4096), send_delay=0.0):
+        self.pending = []
+        self.send_delay = send_delay
+        self.has_pending = asyncio.Event()
+        self.calls = Counter()
+        self.sent = []
+        self.all_sent = asyncio.Event()
+        self.expected = 0
+        self.voice_bytes = voice_bytes
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+
+    def _message(self, chat_id, **fields):
+        return {
+            "message_id": next(self._message_ids), "date": int(time.time()),
+            "chat": {"id": int(chat_id or 0), "type": "private"}, **fields,
+        }
+
+    def _photo(self):
+        file_id = f"photo{next(self._file_ids)}"
+        return [{"file_id": file_id, "file_unique_id": file_id, "width": 1, "height": 1}]
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        data = await request.json() if request.content_type == "application/json" else await request.post()
+        if method == "getMe":
+            result = BOT_INFO
+        elif method == "getUpdates":
+            if not self.pending:
+                self.has_pending.clear()
+                try:
+                    await asyncio.wait_for(self.has_pending.wait(), timeout=float(data.get("timeout", 0) or 0.1))
+                except asyncio.TimeoutError:
+                    pass
+            offset = int(data.get("offset", 0) or 0)
+            self.pending = [u for u in self.pending if u["update_id"] >= offset]
+            result = self.pending[:100]
+        elif method == "getFile":
+            result = {"file_id": data["file_id"], "file_unique_id": data["file_id"], "file_path": "voice/file.oga"}
+        elif method in ("sendMessage", "editMessageText"):
+            if self.send_delay:
+                await asyncio.sleep(self.send_delay)
+            self.sent.append(time.perf_counter())
+            if self.expected and len(self.sent) >= self.expected:
+                self.all_sent.set()
+            result = self._message(data.get("chat_id"), text=data.get("text", ""))
+        elif method == "sendPhoto":
+            result = self._message(data.get("chat_id"), photo=self._photo())
+        elif method == "sendMediaGroup":
+            media = json.loads(data["media"]) if isinstance(data["media"], str) else data["media"]
+            result = [self._message(data.get("chat_id"), photo=self._photo()) for _ in media]
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def file(self, request):
+        self.calls["download"] += 1
+        return web.Response(body=self.voice_bytes)
+
+    def push(self, updates):
+        self.pending.extend(updates)
+        self.has_pending.set()
+
+    def build_app(self):
+        app = web.Application(client_max_size=64 << 20)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        app.router.add_get("/file/bot{token}/{path:.*}", self.file)
+        return app
+
+
+class FakeOpenAI:
+    """
+    Заглушка OpenAI API: chat.completions (обычный и stream), images, audio.transcriptions.
+    Задержка — логнормальная с заданной медианой; часть запросов получает 429.
+    """
+
+    def __init__(self, median_latency=0.5, sigma=0.5, token_delay=0.02, tokens=60, rate_limit_ratio=0.0, seed=1):
+        self.median_latency = median_latency
+        self.sigma = sigma
+        self.token_delay = token_delay
+        self.tokens = tokens
+        self.rate_limit_ratio = rate_limit_ratio
+        self.calls = Counter()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._random = random.Random(seed)
+        self.base_url = ""
+
+    def _latency(self):
+        return self.median_latency * self._random.lognormvariate(0, self.sigma)
+
+    def _rate_limited(self):
+        if self._random.random() < self.rate_limit_ratio:
+            self.calls["429"] += 1
+            return web.json_response(
+                {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                status=429, headers={"retry-after": "0.2"},
+            )
+        return None
+
+    def _track(self, delta):
+        self.in_flight += delta
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    async def chat(self, request):
+        self.calls["chat"] += 1
+        limited = self._rate_limited()
+        if limited:
+            return limited
+        body = await request.json()
+        words = [f"слово{i} " for i in range(self.tokens)]
+        usage = {"prompt_tokens": 50, "completion_tokens": self.tokens, "total_tokens": 50 + self.tokens}
+        self._track(1)
+        try:
+            await asyncio.sleep(self._latency())
+            if not body.get("stream"):
+                return web.json_response({
+                    "id": "chatcmpl-bench", "object": "chat.completion", "created": int(time.time()),
+                    "model": body["model"],
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(words)},
+                                 "finish_reason": "stop"}],
+                    "usage": usage,
+                })
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await response.prepare(request)
+            chunk = {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": body["model"]}
+            for word in words:
+                await asyncio.sleep(self.token_delay)
+                payload = {**chunk, "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]}
+                await response.write(f"data: {json.dumps(payload)}\n\n".encode())
+            await response.write(f"data: {json.dumps({**chunk, 'choices': [], 'usage': usage})}\n\n".encode())
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+            return response
+        finally:
+            self._track(-1)
+
+    async def images(self, request):
+        self.calls["images"] += 1
+        limited = self._rate_limited()
+        if limited:
+            return limited
+        self._track(1)
+        try:
+            await asyncio.sleep(self._latency() * 4)
+        finally:
+            self._track(-1)
+        return web.json_response({"created": int(time.time()), "data": [{"url": f"{self.base_url}/files/image.png"}]})
+
+    async def transcriptions(self, request):
+        self.calls["transcriptions"] += 1
+        limited = self._rate_limited()
+        if limited:
+            return limited
+        await request.read()
+        self._track(1)
+        try:
+            await asyncio.sleep(self._latency())
+        finally:
+            self._track(-1)
+        return web.json_response({"text": "Расскажи что-нибудь хорошее"})
+
+    async def image_file(self, request):
+        return web.Response(body=PNG_BYTES, content_type="image/png")
+
+    def build_app(self, base_url):
+        self.base_url = base_url
+        app = web.Application(client_max_size=64 << 20)
+        app.router.add_post("/v1/chat/completions", self.chat)
+        app.router.add_post("/v1/images/generations", self.images)
+        app.router.add_post("/v1/audio/transcriptions", self.transcriptions)
+        app.router.add_get("/files/image.png", self.image_file)
+        return app
@@ -0,0 +1,233 @@
+"""
+Офлайн-нагрузочный тест бота: настоящие обработчики (start, help_command, handle_message,
+handle_voice) и настоящий ChatOrderedUpdateProcessor против локальных заглушек Bot API и OpenAI.
+Токены не тратятся.
+
+Генерирует пуассоновский поток апдейтов по смеси режимов и множеству chat_id и печатает
+апдейты/с, p50/p95/p99 сквозной задержки, задержку цикла событий и рост RSS по времени.
+С --max-p99 / --min-throughput / --max-rss-growth-mb завершается с кодом 1 при регрессии.
+
+Запуск:
+    python benchmarks/loadtest.py --rate 50 --duration 60 --chats 500 --latency 0.8 --rate-limit-ratio 0.02
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--rate", type=float, default=30, help="апдейтов в секунду")
+parser.add_argument("--duration", type=float, default=30, help="длительность генерации трафика, с")
+parser.add_argument("--chats", type=int, default=300)
+parser.add_argument("--latency", type=float, default=0.5, help="медиана задержки OpenAI, с")
+parser.add_argument("--sigma", type=float, default=0.6, help="разброс логнормальной задержки")
+parser.add_argument("--token-delay", type=float, default=0.01, help="пауза между токенами в stream, с")
+parser.add_argument("--tokens", type=int, default=80, help="токенов в ответе")
+parser.add_argument("--rate-limit-ratio", type=float, default=0.0, help="доля ответов 429")
+parser.add_argument("--mix", default="default=45,psychologist=10,astrologer=5,seo=12,assistant=8,olesya=8,image=4,voice=5,start=2,help=1")
+parser.add_argument("--api-port", type=int, default=18091)
+parser.add_argument("--openai-port", type=int, default=18092)
+parser.add_argument("--sample-interval", type=float, default=5.0, help="период печати RSS/памяти диалогов, с")
+parser.add_argument("--max-p99", type=float, help="порог p99 сквозной задержки, с")
+parser.add_argument("--min-throughput", type=float, help="порог апдейтов/с")
+parser.add_argument("--max-rss-growth-mb", type=float, help="порог роста RSS, МБ")
+parser.add_argument("--seed", type=int, default=1)
+args = parser.parse_args()
+
+# Окружение бота выставляется до импорта: адреса заглушек и щедрые лимиты
+workdir = tempfile.mkdtemp(prefix="tg-bot-loadtest-")
+os.environ.update({
+    "TELEGRAM_BOT_TOKEN": "123456:loadtest",
+    "OPENAI_API_KEY": "loadtest",
+    "OPENAI_BASE_URL": f"http://127.0.0.1:{args.openai_port}/v1",
+    "IMAGE_CACHE_DIR": os.path.join(workdir, "images"),
+    "RATE_CHAT_BURST": "1000000", "RATE_IMAGE_BURST": "1000000", "RATE_TRANSCRIPTION_BURST": "1000000",
+})
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from telegram import Update  # noqa: E402
+
+import bot  # noqa: E402
+from fakes import FakeBotAPI, FakeOpenAI  # noqa: E402
+
+BUTTONS = {key: mode.button for key, mode in bot.MODES.items()}
+TEXTS = {
+    "seo": ["платье, лето, хлопок", "кроссовки, бег, лёгкие", "чайник, стекло, 1.7 л", "Хлопок, платье, ЛЕТО"],
+    "assistant": ["Товар пришёл с царапиной", "Спасибо, всё отлично!", "Когда будет доставка?"],
+}
+
+
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class TrafficGenerator:
+    """Синтетические апдейты: для смены режима чат сначала «нажимает» кнопку меню."""
+
+    def __init__(self, mix, chats, seed):
+        self._random = random.Random(seed)
+        self._kinds, self._weights = zip(*((kind, float(weight)) for kind, weight in
+                                           (item.split("=") for item in mix.split(","))))
+        self._chats = chats
+        self._chat_modes = {}
+        self._update_ids = itertools.count(1)
+
+    def _update(self, chat_id, **message):
+        update_id = next(self._update_ids)
+        return {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id, "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": chat_id, "is_bot": False, "first_name": "U"},
+                **message,
+            },
+        }
+
+    def _text(self, chat_id, text):
+        return self._update(chat_id, text=text)
+
+    def _command(self, chat_id, command):
+        return self._update(chat_id, text=command, entities=[{"type": "bot_command", "offset": 0, "length": len(command)}])
+
+    def next_updates(self):
+        chat_id = 10000 + self._random.randrange(self._chats)
+        kind = self._random.choices(self._kinds, self._weights)[0]
+        if kind in ("start", "help"):
+            return [self._command(chat_id, f"/{kind}")]
+        if kind == "voice":
+            return [self._update(chat_id, voice={"file_id": f"v{chat_id}", "file_unique_id": f"v{chat_id}", "duration": 7})]
+        updates = []
+        if self._chat_modes.get(chat_id, "default") != kind:
+            self._chat_modes[chat_id] = kind
+            updates.append(self._text(chat_id, BUTTONS[kind]))
+        text = self._random.choice(TEXTS.get(kind, [f"Сообщение {self._random.randrange(10**6)}"]))
+        updates.append(self._text(chat_id, text))
+        return updates
+
+
+async def sample_loop_lag(lags, interval=0.05):
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, loop.time() - expected))
+
+
+async def sample_memory(samples, started, interval):
+    while True:
+        await asyncio.sleep(interval)
+        sample = (time.perf_counter() - started, rss_mb(), len(bot.conversation_store), bot.conversation_store.total_tokens)
+        samples.append(sample)
+        print(f"  t={sample[0]:6.1f}с  RSS={sample[1]:7.1f} МБ  диалогов={sample[2]:6d}  токенов истории={sample[3]}")
+
+
+async def main():
+    for name in ("httpx", "telegram", "apscheduler", "aiohttp.access"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    telegram_api = FakeBotAPI()
+    openai_api = FakeOpenAI(
+        median_latency=args.latency, sigma=args.sigma, token_delay=args.token_delay,
+        tokens=args.tokens, rate_limit_ratio=args.rate_limit_ratio, seed=args.seed,
+    )
+    openai_url = f"http://127.0.0.1:{args.openai_port}"
+    runners = [
+        await bot.start_web_server(telegram_api.build_app(), "127.0.0.1", args.api_port),
+        await bot.start_web_server(openai_api.build_app(openai_url), "127.0.0.1", args.openai_port),
+    ]
+    application = bot.build_application(
+        base_url=f"http://127.0.0.1:{args.api_port}/bot",
+        base_file_url=f"http://127.0.0.1:{args.api_port}/file/bot",
+    )
+    await application.initialize()
+    await application.start()
+
+    generator = TrafficGenerator(args.mix, args.chats, args.seed)
+    latencies = []
+    lags = []
+    memory_samples = []
+    tasks = set()
+    random_gaps = random.Random(args.seed + 1)
+    rss_start = rss_mb()
+    started = time.perf_counter()
+    background = [
+        asyncio.create_task(sample_loop_lag(lags)),
+        asyncio.create_task(sample_memory(memory_samples, started, args.sample_interval)),
+    ]
+
+    async def deliver(update):
+        enqueued = time.perf_counter()
+        await application.update_processor.process_update(update, application.process_update(update))
+        latencies.append(time.perf_counter() - enqueued)
+
+    print(f"Трафик: {args.rate} апд/с в течение {args.duration} с, {args.chats} чатов, медиана OpenAI {args.latency} с")
+    sent = 0
+    while time.perf_counter() - started < args.duration:
+        await asyncio.sleep(random_gaps.expovariate(args.rate))
+        for raw in generator.next_updates():
+            task = asyncio.create_task(deliver(Update.de_json(raw, application.bot)))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            sent += 1
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    for task in background:
+        task.cancel()
+    await application.stop()
+    await application.shutdown()
+    await bot.openai_gateway.close()
+    await bot.close_http_session()
+    for runner in runners:
+        await runner.cleanup()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    rss_growth = rss_mb() - rss_start
+    throughput = len(latencies) / elapsed
+    p99 = percentile(latencies, 0.99)
+    print("\n=== Итоги ===")
+    print(f"апдейтов: отправлено {sent}, обработано {len(latencies)}, {throughput:.1f} апд/с")
+    print(
+        f"сквозная задержка: p50={percentile(latencies, 0.5):.2f}с p95={percentile(latencies, 0.95):.2f}с "
+        f"p99={p99:.2f}с max={max(latencies, default=float('nan')):.2f}с"
+    )
+    print(f"лаг цикла событий: p99={percentile(lags, 0.99) * 1000:.1f} мс max={max(lags, default=0) * 1000:.1f} мс")
+    print(f"RSS: {rss_start:.1f} → {rss_mb():.1f} МБ (рост {rss_growth:+.1f} МБ)")
+    print(f"Bot API: {dict(telegram_api.calls)}")
+    print(f"OpenAI: {dict(openai_api.calls)}, одновременно до {openai_api.max_in_flight}")
+    print(f"Кэш ответов: {bot.response_cache.hits} попаданий / {bot.response_cache.misses} промахов")
+    print(f"Метрики: {bot.metrics.summary()}")
+
+    failed = []
+    if args.max_p99 is not None and p99 > args.max_p99:
+        failed.append(f"p99 {p99:.2f}с > {args.max_p99}с")
+    if args.min_throughput is not None and throughput < args.min_throughput:
+        failed.append(f"пропускная способность {throughput:.1f} < {args.min_throughput}")
+    if args.max_rss_growth_mb is not None and rss_growth > args.max_rss_growth_mb:
+        failed.append(f"рост RSS {rss_growth:.1f} МБ > {args.max_rss_growth_mb} МБ")
+    if failed:
+        print("РЕГРЕССИЯ: " + "; ".join(failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,14 +1,35 @@
 import logging
 import os
 import asyncio
+import contextvars
+import hashlib
+import hmac
+import itertools
+import json
+import math
+import random
+import re
+import secrets
+import shutil
 import aiohttp
+from aiohttp import web
+import httpx
+import sqlite3
 import subprocess
+import time
 import tarfile
+import tempfile
+from collections import OrderedDict, defaultdict, deque
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Optional
 import telegram # Импортируем для обработки ошибок
 
-from telegram import Update, KeyboardButton, ReplyKeyboardMarkup
+from telegram import Update, InputMediaPhoto, KeyboardButton, ReplyKeyboardMarkup
 from telegram.ext import (
     ApplicationBuilder,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
     ContextTypes,
@@ -24,13 +45,107 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 if not TELEGRAM_BOT_TOKEN or not OPENAI_API_KEY:
     raise EnvironmentError("Не установлены переменные окружения TELEGRAM_BOT_TOKEN или OPENAI_API_KEY")
 
-# === Инициализация клиента OpenAI ===
-client = openai.OpenAI(api_key=OPENAI_API_KEY)
+# === Настройки OpenAI-шлюза ===
+OPENAI_MAX_IN_FLIGHT = int(os.getenv("OPENAI_MAX_IN_FLIGHT", "16"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+OPENAI_MEDIA_TIMEOUT = float(os.getenv("OPENAI_MEDIA_TIMEOUT", "120"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+OPENAI_RETRY_BASE_DELAY = 1.0
+OPENAI_RETRY_MAX_DELAY = 20.0
+
+# === Настройки параллельной обработки апдейтов ===
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))
+UPDATE_BACKLOG_LIMIT = int(os.getenv("UPDATE_BACKLOG_LIMIT", "500"))
+UPDATE_BACKLOG_WARN = int(os.getenv("UPDATE_BACKLOG_WARN", "50"))
+
+# === Настройки транспорта (long polling или вебхук) ===
+BOT_TRANSPORT = os.getenv("BOT_TRANSPORT", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публичный https-адрес бота, без пути
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+if BOT_TRANSPORT == "webhook" and not WEBHOOK_URL:
+    raise EnvironmentError("Для BOT_TRANSPORT=webhook нужна переменная окружения WEBHOOK_URL")
+
+# === Настройки метрик и профилирования ===
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # для polling: отдельный порт под /metrics и /healthz
+METRICS_LOG_INTERVAL = float(os.getenv("METRICS_LOG_INTERVAL", "300"))
+PROFILE_UPDATES = os.getenv("PROFILE_UPDATES", "0") == "1"
+PROFILE_SLOW_UPDATE = float(os.getenv("PROFILE_SLOW_UPDATE", "0"))
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# === Настройки генерации изображений ===
+IMAGE_VARIANTS = max(1, min(10, int(os.getenv("IMAGE_VARIANTS", "2"))))  # в медиагруппе не больше 10 фото
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "./image_cache")
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_MB", "500")) << 20
+
+# === Настройки лимитов и очереди к OpenAI ===
+# Бюджеты на пользователя: (запас, пополнение в минуту). Для картинок единица — одно сгенерированное
+# изображение (запрос стоит IMAGE_VARIANTS), для транскрипции — секунда аудио.
+RATE_LIMITS = {
+    "chat": (int(os.getenv("RATE_CHAT_BURST", "10")), float(os.getenv("RATE_CHAT_PER_MINUTE", "20"))),
+    "image": (int(os.getenv("RATE_IMAGE_BURST", "2")), float(os.getenv("RATE_IMAGE_PER_MINUTE", "2"))),
+    "transcription": (
+        int(os.getenv("RATE_TRANSCRIPTION_BURST", "600")),
+        float(os.getenv("RATE_TRANSCRIPTION_PER_MINUTE", "300")),
+    ),
+}
+# Сколько запросов каждого типа одновременно уходит в OpenAI; остальные ждут в честной очереди
+SCHEDULER_SLOTS = {
+    "chat": int(os.getenv("SCHEDULER_CHAT_SLOTS", "12")),
+    "image": int(os.getenv("SCHEDULER_IMAGE_SLOTS", "3")),
+    "transcription": int(os.getenv("SCHEDULER_TRANSCRIPTION_SLOTS", "4")),
+}
+RATE_LIMITER_MAX_KEYS = 100000
+
+# === Настройки потоковых ответов ===
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.2"))
+STREAM_MIN_CHARS = int(os.getenv("STREAM_MIN_CHARS", "40"))
+TELEGRAM_MESSAGE_LIMIT = 4096
+STREAM_CURSOR = " ▍"
+
+# === Настройки памяти диалогов ===
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "3000"))
+HISTORY_MAX_MESSAGES = int(os.getenv("HISTORY_MAX_MESSAGES", "40"))
+HISTORY_MAX_CHATS = int(os.getenv("HISTORY_MAX_CHATS", "5000"))
+HISTORY_MAX_TOTAL_TOKENS = int(os.getenv("HISTORY_MAX_TOTAL_TOKENS", "2000000"))
+HISTORY_TTL = float(os.getenv("HISTORY_TTL", str(6 * 3600)))
+HISTORY_DB_PATH = os.getenv("HISTORY_DB_PATH")  # не задан — история только в памяти
+
+# === Настройки кэша ответов ===
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1000"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", str(24 * 3600)))
+RESPONSE_CACHE_DB_PATH = os.getenv("RESPONSE_CACHE_DB_PATH")  # не задан — кэш только в памяти
+RESPONSE_CACHE_DISK_SIZE = int(os.getenv("RESPONSE_CACHE_DISK_SIZE", "20000"))
 
 # === Пути и URL для FFMPEG ===
-FFMPEG_STATIC_URL = "https://johnvansickle.com/ffmpeg/releases/ffmpeg-release-amd64-static.tar.xz"
+FFMPEG_STATIC_URL = os.getenv(
+    "FFMPEG_STATIC_URL", "https://johnvansickle.com/ffmpeg/releases/ffmpeg-release-amd64-static.tar.xz"
+)
+FFMPEG_MD5 = os.getenv("FFMPEG_MD5")  # если задан, контрольная сумма архива не скачивается
 BIN_DIR = "./bin"
 FFMPEG_PATH = os.path.join(BIN_DIR, "ffmpeg")
+FFMPEG_PREFER_SYSTEM = os.getenv("FFMPEG_PREFER_SYSTEM", "1") == "1"
+# Общий для всех экземпляров кэш бинарников, разложенный по контрольной сумме архива
+FFMPEG_CACHE_DIR = os.getenv(
+    "FFMPEG_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "tg_bot", "ffmpeg")
+)
+FFMPEG_DOWNLOAD_CHUNK = 1 << 20
+FFMPEG_MD5_TIMEOUT = 15  # сек.; без сети берём последний проверенный билд из кэша
+FFMPEG_MAX_PROCS = int(os.getenv("FFMPEG_MAX_PROCS", str(os.cpu_count() or 1)))
+# Whisper принимает OGG/Opus напрямую, перекодирование в MP3 включается только явно
+VOICE_TRANSCODE = os.getenv("VOICE_TRANSCODE", "0") == "1"
+# Длинные голосовые режутся по паузам и расшифровываются кусками параллельно
+VOICE_CHUNK_THRESHOLD = float(os.getenv("VOICE_CHUNK_THRESHOLD", "120"))
+VOICE_CHUNK_SECONDS = float(os.getenv("VOICE_CHUNK_SECONDS", "60"))
+VOICE_CHUNK_PARALLELISM = int(os.getenv("VOICE_CHUNK_PARALLELISM", "4"))
+VOICE_SILENCE_NOISE = os.getenv("VOICE_SILENCE_NOISE", "-35dB")
+VOICE_SILENCE_MIN = float(os.getenv("VOICE_SILENCE_MIN", "0.4"))
+WHISPER_MAX_BYTES = 25 * 1024 * 1024
 
 
 # === Логгирование ===
@@ -41,71 +156,1636 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+# === Метрики ===
+current_mode = contextvars.ContextVar("current_mode", default="-")
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class Metrics:
+    """
+    Счётчики, гистограммы и gauge-метрики в памяти процесса с выдачей в текстовом формате Prometheus.
+    Этапы обработки замеряются через `stage()`: время, число запросов в работе и ошибки по типу исключения.
+    """
+
+    def __init__(self, buckets):
+        self._buckets = buckets
+        self._counters = defaultdict(float)
+        self._gauges = defaultdict(float)
+        self._gauge_callbacks = {}
+        self._histograms = {}
+        self._help = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        self._counters[self._key(name, labels)] += value
+
+    def counter(self, name, **labels):
+        return self._counters.get(self._key(name, labels), 0)
+
+    def gauge_add(self, name, value, **labels):
+        self._gauges[self._key(name, labels)] += value
+
+    def register_gauge(self, name, callback, **labels):
+        """Gauge, значение которого вычисляется в момент выдачи метрик."""
+        self._gauge_callbacks[self._key(name, labels)] = callback
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = [0] * len(self._buckets) + [0.0, 0]
+        for index, bound in enumerate(self._buckets):
+            if value <= bound:
+                histogram[index] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    @contextmanager
+    def stage(self, stage, mode=None):
+        mode = mode or current_mode.get()
+        self.gauge_add("bot_stage_in_flight", 1, stage=stage)
+        started = time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = type(e).__name__
+            self.inc("bot_stage_errors_total", stage=stage, mode=mode, type=error)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            self.gauge_add("bot_stage_in_flight", -1, stage=stage)
+            self.observe("bot_stage_seconds", elapsed, stage=stage, mode=mode)
+            trace = current_trace.get()
+            if trace is not None:
+                trace.append((stage, started, elapsed, error))
+
+    def record_usage(self, usage, model):
+        if usage is None:
+            return
+        mode = current_mode.get()
+        self.inc("bot_openai_prompt_tokens_total", usage.prompt_tokens or 0, model=model, mode=mode)
+        self.inc("bot_openai_completion_tokens_total", usage.completion_tokens or 0, model=model, mode=mode)
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        pairs = [f'{name}="{value}"' for name, value in (*labels, *extra)]
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self):
+        lines = []
+        gauges = dict(self._gauges)
+        for key, callback in self._gauge_callbacks.items():
+            gauges[key] = callback()
+        for kind, series in (("counter", self._counters), ("gauge", gauges)):
+            for name in sorted({name for name, _ in series}):
+                lines.append(f"# TYPE {name} {kind}")
+                for (series_name, labels), value in series.items():
+                    if series_name == name:
+                        lines.append(f"{name}{self._format_labels(labels)} {value:g}")
+        for name in sorted({name for name, _ in self._histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (series_name, labels), histogram in self._histograms.items():
+                if series_name != name:
+                    continue
+                for bound, count in zip(self._buckets, histogram):
+                    lines.append(f"{name}_bucket{self._format_labels(labels, (('le', f'{bound:g}'),))} {count}")
+                lines.append(f"{name}_bucket{self._format_labels(labels, (('le', '+Inf'),))} {histogram[-1]}")
+                lines.append(f"{name}_sum{self._format_labels(labels)} {histogram[-2]:.6f}")
+                lines.append(f"{name}_count{self._format_labels(labels)} {histogram[-1]}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        parts = []
+        for (name, labels), histogram in sorted(self._histograms.items()):
+            if name == "bot_stage_seconds" and histogram[-1]:
+                label_text = "/".join(str(value) for _, value in labels)
+                parts.append(f"{label_text}: n={histogram[-1]} avg={histogram[-2] / histogram[-1]:.2f}с")
+        tokens = defaultdict(float)
+        errors = 0
+        for (name, _), value in self._counters.items():
+            if name.endswith("_tokens_total"):
+                tokens[name] += value
+            elif name == "bot_stage_errors_total":
+                errors += value
+        parts.append(
+            f"токены prompt={tokens['bot_openai_prompt_tokens_total']:g} "
+            f"completion={tokens['bot_openai_completion_tokens_total']:g}, ошибок={errors:g}"
+        )
+        return "; ".join(parts)
+
+
+metrics = Metrics(LATENCY_BUCKETS)
+
+
+def dump_trace(update, trace, started, elapsed):
+    """Пишет в лог все этапы одного апдейта (включается PROFILE_UPDATES)."""
+    chat = update.effective_chat.id if isinstance(update, Update) and update.effective_chat else "-"
+    spans = ", ".join(
+        f"{stage} +{span_start - started:.3f}с {span_elapsed:.3f}с" + (f" [{error}]" if error else "")
+        for stage, span_start, span_elapsed, error in trace
+    )
+    logger.info(f"Трассировка апдейта: чат={chat} режим={current_mode.get()} всего={elapsed:.3f}с | {spans}")
+
+
+async def log_metrics_periodically(interval):
+    while True:
+        await asyncio.sleep(interval)
+        logger.info(f"Метрики: {metrics.summary()}")
+
+
+# === Асинхронный шлюз OpenAI ===
+class OpenAIGateway:
+    """
+    Общая точка доступа к OpenAI для всех режимов. Работает поверх AsyncOpenAI,
+    ограничивает число одновременных запросов, держит собственный пул
+    HTTP-соединений и повторяет запросы при 429/5xx с экспоненциальной задержкой и джиттером.
+    """
+
+    RETRYABLE_ERRORS = (
+        openai.RateLimitError,
+        openai.InternalServerError,
+        openai.APIConnectionError,  # включает APITimeoutError
+    )
+
+    def __init__(self, api_key, max_in_flight, timeout, max_retries):
+        self._client = openai.AsyncOpenAI(
+            api_key=api_key,
+            timeout=timeout,
+            max_retries=0,  # повторами управляет шлюз, а не SDK
+            http_client=openai.DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=max_in_flight,
+                    max_keepalive_connections=max_in_flight,
+                ),
+            ),
+        )
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._timeout = timeout
+        self._max_retries = max_retries
+
+    @staticmethod
+    def _retry_delay(error, attempt):
+        retry_after = None
+        if isinstance(error, openai.APIStatusError):
+            retry_after = error.response.headers.get("retry-after")
+        try:
+            if retry_after is not None:
+                return min(float(retry_after), OPENAI_RETRY_MAX_DELAY) + random.uniform(0, 1)
+        except ValueError:
+            pass
+        # «Полный джиттер»: случайная задержка до экспоненциального потолка
+        return random.uniform(0, min(OPENAI_RETRY_MAX_DELAY, OPENAI_RETRY_BASE_DELAY * 2 ** attempt))
+
+    async def _with_retries(self, request):
+        attempt = 0
+        while True:
+            try:
+                return await request()
+            except self.RETRYABLE_ERRORS as e:
+                if attempt >= self._max_retries:
+                    raise
+                delay = self._retry_delay(e, attempt)
+                attempt += 1
+                metrics.inc("bot_openai_retries_total", type=type(e).__name__)
+                logger.warning(
+                    f"Запрос к OpenAI не удался ({type(e).__name__}), "
+                    f"повтор {attempt}/{self._max_retries} через {delay:.1f} с"
+                )
+                await asyncio.sleep(delay)
+
+    async def _call(self, stage, method, timeout=None, **kwargs):
+        async def request():
+            async with self._semaphore:
+                return await method(timeout=timeout or self._timeout, **kwargs)
+        with metrics.stage(stage):
+            return await self._with_retries(request)
+
+    async def chat(self, timeout=None, **kwargs):
+        response = await self._call("gpt", self._client.chat.completions.create, timeout, **kwargs)
+        metrics.record_usage(response.usage, kwargs.get("model"))
+        return response
+
+    async def chat_stream(self, timeout=None, **kwargs):
+        """
+        Асинхронный генератор текстовых фрагментов ответа (stream=True).
+        Слот пула берётся на каждую попытку (пауза перед повтором его не держит) и после удачной
+        попытки остаётся занят, пока поток не дочитан; повторы возможны только до первого фрагмента.
+        """
+        started = time.perf_counter()
+        first_token = True
+
+        async def request():
+            await self._semaphore.acquire()
+            try:
+                return await self._client.chat.completions.create(
+                    timeout=timeout or self._timeout,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                    **kwargs
+                )
+            except BaseException:
+                self._semaphore.release()
+                raise
+
+        with metrics.stage("gpt_stream"):
+            stream = await self._with_retries(request)
+            try:
+                async with stream:
+                    async for chunk in stream:
+                        if chunk.usage:
+                            metrics.record_usage(chunk.usage, kwargs.get("model"))
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            if first_token:
+                                first_token = False
+                                metrics.observe(
+                                    "bot_time_to_first_token_seconds", time.perf_counter() - started,
+                                    mode=current_mode.get()
+                                )
+                            yield chunk.choices[0].delta.content
+            finally:
+                self._semaphore.release()
+
+    async def generate_image(self, timeout=OPENAI_MEDIA_TIMEOUT, **kwargs):
+        return await self._call("dalle", self._client.images.generate, timeout, **kwargs)
+
+    async def transcribe(self, timeout=OPENAI_MEDIA_TIMEOUT, **kwargs):
+        return await self._call("whisper", self._client.audio.transcriptions.create, timeout, **kwargs)
+
+    async def close(self):
+        await self._client.close()
+
+
+openai_gateway = OpenAIGateway(
+    api_key=OPENAI_API_KEY,
+    max_in_flight=OPENAI_MAX_IN_FLIGHT,
+    timeout=OPENAI_TIMEOUT,
+    max_retries=OPENAI_MAX_RETRIES,
+)
+
+
+async def fetch_ffmpeg_md5(session):
+    if FFMPEG_MD5:
+        return FFMPEG_MD5.lower()
+    async with session.get(FFMPEG_STATIC_URL + ".md5", timeout=aiohttp.ClientTimeout(total=FFMPEG_MD5_TIMEOUT)) as resp:
+        if resp.status != 200:
+            raise RuntimeError(f"Не удалось скачать контрольную сумму FFMPEG. Статус код: {resp.status}")
+        return (await resp.text()).split()[0].lower()
+
+
+def read_current_ffmpeg_md5():
+    """md5 последнего проверенного и распакованного билда (указатель `current` в кэше) или None."""
+    try:
+        with open(os.path.join(FFMPEG_CACHE_DIR, "current"), encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def write_current_ffmpeg_md5(md5):
+    # Кэш общий для нескольких экземпляров: у каждого свой временный файл, побеждает последний os.replace
+    fd, tmp_path = tempfile.mkstemp(dir=FFMPEG_CACHE_DIR, prefix="current.")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(md5)
+        os.replace(tmp_path, os.path.join(FFMPEG_CACHE_DIR, "current"))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+async def download_archive(session, url, directory):
+    """Скачивает архив на диск по частям, считая md5 на лету. Возвращает (путь, md5)."""
+    digest = hashlib.md5()
+    fd, archive_path = tempfile.mkstemp(dir=directory, suffix=".tar.xz")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            async with session.get(url) as resp:
+                if resp.status != 200:
+                    raise RuntimeError(f"Не удалось скачать FFMPEG. Статус код: {resp.status}")
+                async for chunk in resp.content.iter_chunked(FFMPEG_DOWNLOAD_CHUNK):
+                    digest.update(chunk)
+                    f.write(chunk)
+    except BaseException:
+        os.remove(archive_path)
+        raise
+    return archive_path, digest.hexdigest()
+
+
+def extract_ffmpeg(archive_path, destination):
+    """
+    Один потоковый проход по архиву: распаковывается только член `*/ffmpeg`,
+    чтение останавливается сразу после него. Результат атомарно переносится в `destination`.
+    """
+    with tarfile.open(archive_path, "r|xz") as tar:
+        for member in tar:
+            if member.isfile() and member.name.endswith("/ffmpeg"):
+                source = tar.extractfile(member)
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(destination))
+                try:
+                    with os.fdopen(fd, "wb") as target:
+                        shutil.copyfileobj(source, target, FFMPEG_DOWNLOAD_CHUNK)
+                    os.chmod(tmp_path, 0o755)
+                    os.replace(tmp_path, destination)
+                except BaseException:
+                    os.remove(tmp_path)
+                    raise
+                return
+    raise RuntimeError("ffmpeg не найден в распакованном архиве")
+
+
+def install_ffmpeg(cached_path):
+    """Кладёт бинарник из кэша в BIN_DIR жёсткой ссылкой (или копией, если ссылка невозможна)."""
+    os.makedirs(BIN_DIR, exist_ok=True)
+    # Уникальное имя: экземпляры, запущенные одновременно, не мешают друг другу
+    tmp_path = f"{FFMPEG_PATH}.{os.getpid()}.{secrets.token_hex(4)}.tmp"
+    try:
+        try:
+            os.link(cached_path, tmp_path)
+        except OSError:
+            shutil.copy2(cached_path, tmp_path)
+        os.replace(tmp_path, FFMPEG_PATH)
+    finally:
+        # rename() ничего не делает, если FFMPEG_PATH уже ссылка на тот же файл, — временное имя убираем сами
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+
+
 async def ensure_ffmpeg():
     """
-    Проверяет наличие ffmpeg. Если его нет, скачивает статический билд,
-    распаковывает и делает исполняемым.
+    Находит ffmpeg: системный из PATH, ранее установленный в BIN_DIR или из общего кэша.
+    Иначе скачивает статический билд потоково, проверяет md5 и распаковывает в отдельном потоке.
+    Если контрольную сумму получить не удалось, используется последний проверенный билд из кэша.
     """
+    global FFMPEG_PATH
+    system_ffmpeg = shutil.which("ffmpeg") if FFMPEG_PREFER_SYSTEM else None
+    if system_ffmpeg:
+        FFMPEG_PATH = system_ffmpeg
+        logger.info(f"✅ Использую системный FFMPEG: {FFMPEG_PATH}")
+        return
     if os.path.isfile(FFMPEG_PATH):
         logger.info(f"✅ FFMPEG уже на месте: {FFMPEG_PATH}")
         os.chmod(FFMPEG_PATH, 0o755)
         return
-    logger.info("⬇️ FFMPEG не найден. Скачиваю статический билд...")
-    os.makedirs(BIN_DIR, exist_ok=True)
-    archive_path = os.path.join(BIN_DIR, "ffmpeg.tar.xz")
     try:
         async with aiohttp.ClientSession() as session:
-            async with session.get(FFMPEG_STATIC_URL) as resp:
-                if resp.status != 200:
-                    raise RuntimeError(f"Не удалось скачать FFMPEG. Статус код: {resp.status}")
-                with open(archive_path, "wb") as f:
-                    f.write(await resp.read())
-        logger.info("📦 Архив FFMPEG успешно скачан.")
-        logger.info("Распаковываю архив FFMPEG...")
-        with tarfile.open(archive_path, "r:xz") as tar:
-            for member in tar.getmembers():
-                if member.name.endswith('/ffmpeg'):
-                    member.name = os.path.basename(member.name)
-                    tar.extract(member, path=BIN_DIR)
-                    break
-        if not os.path.isfile(FFMPEG_PATH):
-            raise RuntimeError("ffmpeg не найден в распакованном архиве")
-        os.chmod(FFMPEG_PATH, 0o755)
+            try:
+                expected_md5 = await fetch_ffmpeg_md5(session)
+            except (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError) as e:
+                expected_md5 = read_current_ffmpeg_md5()
+                if not expected_md5 or not os.path.isfile(os.path.join(FFMPEG_CACHE_DIR, expected_md5, "ffmpeg")):
+                    raise
+                logger.warning(f"Не удалось получить контрольную сумму FFMPEG ({e!r}), беру проверенный билд из кэша")
+            cache_dir = os.path.join(FFMPEG_CACHE_DIR, expected_md5)
+            cached_path = os.path.join(cache_dir, "ffmpeg")
+            if os.path.isfile(cached_path):
+                logger.info(f"📦 FFMPEG найден в кэше: {cached_path}")
+            else:
+                logger.info("⬇️ FFMPEG не найден. Скачиваю статический билд...")
+                os.makedirs(cache_dir, exist_ok=True)
+                archive_path, actual_md5 = await download_archive(session, FFMPEG_STATIC_URL, cache_dir)
+                try:
+                    if actual_md5 != expected_md5:
+                        raise RuntimeError(f"Контрольная сумма архива FFMPEG не совпадает: {actual_md5} != {expected_md5}")
+                    logger.info("📦 Архив FFMPEG скачан и проверен. Распаковываю...")
+                    await asyncio.to_thread(extract_ffmpeg, archive_path, cached_path)
+                finally:
+                    os.remove(archive_path)
+        write_current_ffmpeg_md5(expected_md5)
+        await asyncio.to_thread(install_ffmpeg, cached_path)
         logger.info(f"✅ FFMPEG готов к использованию: {FFMPEG_PATH}")
     except Exception as e:
         logger.error(f"Произошла ошибка при установке FFMPEG: {e}")
         raise
+
+# === Работа с ffmpeg через пайпы ===
+ffmpeg_semaphore = asyncio.Semaphore(FFMPEG_MAX_PROCS)
+
+
+async def run_ffmpeg(args, input_bytes, loglevel="error"):
+    """
+    Прогоняет байты через ffmpeg (stdin -> stdout) без временных файлов.
+    Число одновременных процессов ограничено FFMPEG_MAX_PROCS. Возвращает (stdout, stderr).
+    """
+    async with ffmpeg_semaphore:
+        with metrics.stage("ffmpeg"):
+            process = await asyncio.create_subprocess_exec(
+                FFMPEG_PATH, "-hide_banner", "-loglevel", loglevel, *args,
+                stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+            )
+            stdout, stderr = await process.communicate(input_bytes)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd=FFMPEG_PATH, output=stdout, stderr=stderr)
+    return stdout, stderr
+
+
+async def transcode_to_mp3(audio_bytes):
+    stdout, _ = await run_ffmpeg(["-i", "pipe:0", "-f", "mp3", "pipe:1"], audio_bytes)
+    return stdout
+
+
+SILENCE_RE = re.compile(r"silence_(start|end): (-?[\d.]+)")
+
+
+async def detect_silences(audio_bytes):
+    """Паузы в записи по фильтру silencedetect: список (начало, конец) в секундах."""
+    _, stderr = await run_ffmpeg(
+        ["-i", "pipe:0", "-af", f"silencedetect=noise={VOICE_SILENCE_NOISE}:d={VOICE_SILENCE_MIN}", "-f", "null", "-"],
+        audio_bytes,
+        loglevel="info",
+    )
+    silences = []
+    start = None
+    for kind, value in SILENCE_RE.findall(stderr.decode("utf-8", "replace")):
+        if kind == "start":
+            start = float(value)
+        elif start is not None:
+            silences.append((start, float(value)))
+            start = None
+    return silences
+
+
+def plan_chunks(duration, silences, target):
+    """
+    Границы кусков около `target` секунд: режем посередине ближайшей паузы
+    в окне [0.5; 1.5] * target, а если пауз нет — ровно по `target`.
+    """
+    midpoints = [(start + end) / 2 for start, end in silences]
+    bounds = [0.0]
+    while duration - bounds[-1] > target * 1.5:
+        ideal = bounds[-1] + target
+        candidates = [point for point in midpoints if bounds[-1] + target * 0.5 <= point <= bounds[-1] + target * 1.5]
+        bounds.append(min(candidates, key=lambda point: abs(point - ideal)) if candidates else ideal)
+    bounds.append(duration)
+    return list(zip(bounds, bounds[1:]))
+
+
+async def compress_chunk(audio_bytes, start, end):
+    """Кусок записи в моно 16 кГц Opus с низким битрейтом — компактный формат для речи."""
+    stdout, _ = await run_ffmpeg(
+        ["-ss", f"{start:.3f}", "-t", f"{end - start:.3f}", "-i", "pipe:0",
+         "-ac", "1", "-ar", "16000", "-c:a", "libopus", "-b:a", "24k", "-application", "voip",
+         "-f", "ogg", "pipe:1"],
+        audio_bytes,
+    )
+    return stdout
+
+
+async def prepare_voice_for_whisper(audio_bytes):
+    """Возвращает (имя файла, байты) для загрузки в Whisper."""
+    if VOICE_TRANSCODE:
+        return "voice.mp3", await transcode_to_mp3(audio_bytes)
+    return "voice.ogg", audio_bytes
+
+
+# === Параллельная обработка апдейтов ===
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Обрабатывает апдейты разных чатов параллельно (не более `concurrency` одновременно),
+    а апдейты одного чата — строго по очереди, чтобы история и режим в user_data не гонялись.
+    Если очередь ожидающих апдейтов превышает `backlog_limit`, новые апдейты отбрасываются.
+    С `backlog_limit=None` апдейты не отбрасываются: перед процессором стоит вебхук, который сам отвечает 503.
+    """
+
+    def __init__(self, concurrency, backlog_limit, backlog_warn):
+        # Семафор базового класса делаем «бесконечным»: реальный лимит и учёт очереди — ниже
+        queue_limit = WEBHOOK_QUEUE_SIZE if backlog_limit is None else backlog_limit
+        super().__init__(max_concurrent_updates=concurrency + queue_limit + 1)
+        self._slots = asyncio.Semaphore(concurrency)
+        self._chat_locks = {}
+        self.backlog_limit = backlog_limit
+        self._backlog_warn = backlog_warn
+        self.backlog = 0
+        self.in_progress = 0
+        self.reserved = 0
+
+    def reserve(self):
+        """Учитывает апдейт, принятый вебхуком, ещё до того, как он дойдёт до процессора."""
+        self.reserved += 1
+
+    @staticmethod
+    def _chat_key(update):
+        if isinstance(update, Update) and update.effective_chat:
+            return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        if self.reserved:
+            # Вебхук уже подтвердил апдейт с учётом лимита — отбрасывать его нельзя
+            self.reserved -= 1
+        elif self.backlog_limit is not None and self.backlog >= self.backlog_limit:
+            coroutine.close()
+            metrics.inc("bot_updates_dropped_total")
+            logger.warning(f"Очередь апдейтов переполнена ({self.backlog}), апдейт отброшен")
+            return
+        self.backlog += 1
+        if self.backlog >= self._backlog_warn and self.backlog % self._backlog_warn == 0:
+            logger.warning(f"Очередь апдейтов растёт: {self.backlog} в ожидании, {self.in_progress} в работе")
+        chat_key = self._chat_key(update)
+        lock = None
+        if chat_key is not None:
+            lock, waiters = self._chat_locks.get(chat_key, (asyncio.Lock(), 0))
+            self._chat_locks[chat_key] = (lock, waiters + 1)
+        queued = True
+        enqueued = time.perf_counter()
+        try:
+            if lock is not None:
+                await lock.acquire()
+            try:
+                async with self._slots:
+                    self.backlog -= 1
+                    queued = False
+                    metrics.observe("bot_update_queue_seconds", time.perf_counter() - enqueued)
+                    self.in_progress += 1
+                    try:
+                        await self._run(update, coroutine)
+                    finally:
+                        self.in_progress -= 1
+            finally:
+                if lock is not None:
+                    lock.release()
+        finally:
+            if queued:
+                self.backlog -= 1
+                coroutine.close()
+            if lock is not None:
+                _, waiters = self._chat_locks[chat_key]
+                if waiters <= 1:
+                    del self._chat_locks[chat_key]
+                else:
+                    self._chat_locks[chat_key] = (lock, waiters - 1)
+
+    @staticmethod
+    async def _run(update, coroutine):
+        trace = [] if PROFILE_UPDATES else None
+        current_trace.set(trace)
+        started = time.perf_counter()
+        try:
+            await coroutine
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.observe("bot_update_seconds", elapsed, mode=current_mode.get())
+            metrics.inc("bot_updates_total", mode=current_mode.get())
+            if trace is not None and elapsed >= PROFILE_SLOW_UPDATE:
+                dump_trace(update, trace, started, elapsed)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+# === Потоковые ответы ===
+HTML_TAG_RE = re.compile(r"<(/?)([bi])>")
+
+
+def trim_partial_html(text):
+    """Отрезает недописанный тег или сущность в конце ещё генерируемого HTML-превью."""
+    if text.rfind("<") > text.rfind(">"):
+        text = text[:text.rfind("<")]
+    return re.sub(r"&#?\w*$", "", text)
+
+
+def close_open_html_tags(text):
+    """Закрывает незакрытые <b>/<i> (например, в части длинного ответа после split_message)."""
+    open_tags = []
+    for closing, tag in HTML_TAG_RE.findall(text):
+        if not closing:
+            open_tags.append(tag)
+        elif open_tags and open_tags[-1] == tag:
+            open_tags.pop()
+    return text + "".join(f"</{tag}>" for tag in reversed(open_tags))
+
+
+def as_seconds(value):
+    """Длительности в python-telegram-bot бывают int или timedelta — приводим к секундам."""
+    return value.total_seconds() if hasattr(value, "total_seconds") else (value or 0)
+
+
+def escape_markdown_code(text):
+    """Экранирует текст для блока ``` в MarkdownV2."""
+    return text.replace("\\", "\\\\").replace("`", "\\`")
+
+
+def split_message(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Режет длинный текст на части по абзацам/строкам, чтобы уложиться в лимит Telegram."""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n\n", 0, limit)
+        if cut <= 0:
+            cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    parts.append(text)
+    return parts
+
+
+async def safe_edit_text(message, text, parse_mode=None):
+    try:
+        await message.edit_text(text, parse_mode=parse_mode)
+    except telegram.error.BadRequest as e:
+        if "not modified" not in str(e):
+            raise
+
+
+async def stream_into_message(message, deltas, render_partial, parse_mode):
+    """
+    Собирает фрагменты ответа и правит сообщение-заглушку не чаще STREAM_EDIT_INTERVAL
+    (лимиты Telegram на правки в одном чате). Возвращает полный текст ответа.
+    Поток читается отдельной задачей, чтобы правки в Telegram не задерживали чтение ответа OpenAI.
+    """
+    loop = asyncio.get_running_loop()
+    parts = []
+    received = asyncio.Event()
+
+    async def read_deltas():
+        async for delta in deltas:
+            parts.append(delta)
+            received.set()
+
+    reader = asyncio.create_task(read_deltas())
+    shown_len = 0
+    next_edit = 0.0
+    try:
+        while not reader.done():
+            text = "".join(parts)
+            if len(text) > TELEGRAM_MESSAGE_LIMIT - 200:
+                # Превью больше не помещается в одно сообщение — дальше только финальная правка
+                await asyncio.wait({reader})
+                break
+            now = loop.time()
+            if now < next_edit:
+                await asyncio.wait({reader}, timeout=next_edit - now)
+                continue
+            if len(text) - shown_len < STREAM_MIN_CHARS:
+                received.clear()
+                waiter = asyncio.create_task(received.wait())
+                await asyncio.wait({reader, waiter}, return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+                continue
+            shown_len = len(text)
+            next_edit = now + STREAM_EDIT_INTERVAL
+            try:
+                if parse_mode:
+                    await safe_edit_text(message, render_partial(text), parse_mode)
+                else:
+                    await safe_edit_text(message, text + STREAM_CURSOR)
+            except telegram.error.RetryAfter as e:
+                next_edit = now + as_seconds(e.retry_after)
+            except telegram.error.BadRequest as e:
+                logger.warning(f"Не удалось отрисовать частичный ответ, дальше без форматирования. Ошибка: {e}")
+                parse_mode = None
+            except telegram.error.TelegramError as e:
+                # Превью необязательно: сетевой сбой не должен обрывать генерацию, ответ придёт финальной правкой
+                logger.warning(f"Не удалось обновить частичный ответ: {e}")
+        await reader
     finally:
-        if os.path.exists(archive_path):
-            os.remove(archive_path)
+        reader.cancel()
+    return "".join(parts)
+
+
+async def finish_streamed_reply(message, text, parse_mode, plain_text=None):
+    """
+    Финальная правка сообщения. При ошибке разметки, как и раньше, отправляем текст без форматирования.
+    Ответ длиннее лимита Telegram продолжается новыми сообщениями.
+    """
+    with metrics.stage("telegram_reply"):
+        parts = split_message(text)
+        for index, part in enumerate(parts):
+            if parse_mode == "HTML":
+                part = close_open_html_tags(part)
+            fallback = plain_text if plain_text is not None and len(parts) == 1 else part
+            try:
+                if index == 0:
+                    await safe_edit_text(message, part, parse_mode)
+                else:
+                    await message.reply_text(part, parse_mode=parse_mode)
+            except telegram.error.BadRequest as e:
+                if 'entities' not in str(e):
+                    raise
+                logger.warning(f"Ошибка парсинга {parse_mode}, отправляю текст без форматирования. Ошибка: {e}")
+                if index == 0:
+                    await safe_edit_text(message, fallback)
+                else:
+                    await message.reply_text(fallback)
+
+
+# === Лимиты и честная очередь ===
+class TokenBucket:
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, capacity, per_minute):
+        self.capacity = capacity
+        self.rate = per_minute / 60
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, cost):
+        self._refill()
+        # Запрос дороже всего запаса (длинное голосовое) пропускаем при полном ведре
+        if self.tokens >= min(cost, self.capacity):
+            self.tokens -= cost
+            return True
+        return False
+
+    def retry_after(self, cost):
+        self._refill()
+        missing = min(cost, self.capacity) - self.tokens
+        return max(0.0, missing / self.rate) if self.rate else float("inf")
+
+
+class RateLimiter:
+    """Token bucket на каждую пару (пользователь, бюджет); давно не использованные вёдра вытесняются."""
+
+    def __init__(self, limits, max_keys):
+        self._limits = limits
+        self._max_keys = max_keys
+        self._buckets = OrderedDict()
+
+    def _bucket(self, user_id, budget):
+        key = (user_id, budget)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(*self._limits[budget])
+            if len(self._buckets) > self._max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def try_acquire(self, user_id, budget, cost=1):
+        """Возвращает 0, если запрос пропущен, иначе — через сколько секунд повторить."""
+        bucket = self._bucket(user_id, budget)
+        if bucket.try_take(cost):
+            return 0
+        return bucket.retry_after(cost)
+
+
+class FairScheduler:
+    """
+    Ограничивает число одновременных запросов одного типа и раздаёт освободившиеся слоты
+    по кругу между пользователями, чтобы один активный пользователь не занимал всю очередь.
+    """
+
+    def __init__(self, slots):
+        self._free = slots
+        self._queues = OrderedDict()
+
+    @property
+    def waiting(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _position(self, user_id):
+        """Номер в очереди для последнего запроса пользователя с учётом кругового обхода."""
+        my_round = len(self._queues[user_id]) - 1
+        position = 1
+        before_me = True
+        for other_id, queue in self._queues.items():
+            if other_id == user_id:
+                before_me = False
+                position += my_round
+                continue
+            position += min(len(queue), my_round + 1 if before_me else my_round)
+        return position
+
+    def _release(self):
+        while self._queues:
+            user_id, queue = next(iter(self._queues.items()))
+            future = queue.popleft()
+            if queue:
+                self._queues.move_to_end(user_id)
+            else:
+                del self._queues[user_id]
+            if not future.done():
+                future.set_result(None)
+                return
+        self._free += 1
+
+    @asynccontextmanager
+    async def slot(self, user_id, on_queued=None):
+        if self._free > 0 and not self._queues:
+            self._free -= 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self._queues.setdefault(user_id, deque()).append(future)
+            try:
+                if on_queued is not None:
+                    await on_queued(self._position(user_id))
+                await future
+            except BaseException:
+                if future.done() and not future.cancelled():
+                    self._release()
+                else:
+                    future.cancel()
+                raise
+        try:
+            yield
+        finally:
+            self._release()
+
+
+rate_limiter = RateLimiter(RATE_LIMITS, RATE_LIMITER_MAX_KEYS)
+schedulers = {budget: FairScheduler(slots) for budget, slots in SCHEDULER_SLOTS.items()}
+
+
+def request_owner(update):
+    return update.effective_user.id if update.effective_user else update.effective_chat.id
+
+
+async def check_rate_limit(update, budget, cost=1):
+    """Отклоняет запрос сразу, если бюджет пользователя исчерпан."""
+    retry_after = rate_limiter.try_acquire(request_owner(update), budget, cost)
+    if not retry_after:
+        return True
+    metrics.inc("bot_rate_limited_total", budget=budget)
+    await update.message.reply_text(
+        f"⏳ Слишком много запросов. Попробуйте снова через {math.ceil(retry_after)} с."
+    )
+    return False
+
+
+@asynccontextmanager
+async def fair_slot(update, budget, notify_user=True):
+    """Слот в честной очереди к OpenAI; если придётся ждать, сообщаем пользователю его место."""
+    async def notify(position):
+        metrics.inc("bot_scheduler_queued_total", budget=budget)
+        if not notify_user:
+            return
+        try:
+            await update.message.reply_text(f"🕒 Много запросов, вы в очереди: {position}-е место.")
+        except telegram.error.TelegramError as e:
+            # Сообщение о месте в очереди необязательно: запрос остаётся в очереди
+            logger.warning(f"Не удалось сообщить место в очереди: {e}")
+
+    async with schedulers[budget].slot(request_owner(update), notify):
+        yield
+
+
+async def scheduled_stream(update, budget, deltas):
+    """Потоковый ответ OpenAI, который держит слот очереди, пока поток не дочитан."""
+    async with fair_slot(update, budget):
+        async for delta in deltas:
+            yield delta
+
 
 # === Истории чатов ===
-chat_histories = { "default": {}, "psychologist": {}, "astrologer": {} }
-MAX_HISTORY_PAIRS = 10
-
-def get_chat_history(chat_id, mode):
-    return chat_histories.get(mode, {}).setdefault(chat_id, [])
-
-def trim_chat_history(history):
-    if len(history) > MAX_HISTORY_PAIRS * 2:
-        return history[-(MAX_HISTORY_PAIRS * 2):]
-    return history
-
-def build_keyboard():
-    keyboard = [
-        [KeyboardButton("📈 SEO"), KeyboardButton("🌍 Изображение")],
-        [KeyboardButton("💁‍♀️ Помощница"), KeyboardButton("🧘‍♀️ Олеся")],
-        [KeyboardButton("💬 Психолог"), KeyboardButton("🔮 Астролог")],
-        [KeyboardButton("🔙 Назад в главное меню")]
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+def estimate_tokens(text):
+    """Грубая оценка числа токенов (кириллица — примерно 3 символа на токен) плюс служебные токены сообщения."""
+    return len(text) // 3 + 4
+
+
+class SQLiteBackend:
+    """Соединение SQLite, которое обслуживает один фоновый поток, чтобы не блокировать цикл событий."""
+
+    def __init__(self, path, schema):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        for statement in schema:
+            self._connection.execute(statement)
+        self._connection.commit()
+
+    async def run(self, func, *args):
+        """Выполняет func(connection, *args) в потоке базы."""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, self._connection, *args)
+
+    def close(self):
+        self._executor.submit(self._connection.close).result()
+        self._executor.shutdown()
+
+
+class _Conversation:
+    __slots__ = ("messages", "tokens", "touched")
+
+    def __init__(self, max_messages):
+        self.messages = deque(maxlen=max_messages)
+        self.tokens = 0
+        self.touched = time.monotonic()
+
+
+class ConversationStore:
+    """
+    Память диалогов режимов чата. Для каждого (режим, чат) хранится кольцевой буфер,
+    который реально усекается по бюджету токенов. Неактивные чаты вытесняются
+    по LRU/TTL при превышении общего лимита. Если задан `db_path`, история
+    дублируется в SQLite и подгружается лениво, при первом обращении к чату.
+    """
+
+    def __init__(self, token_budget, max_messages, max_chats, max_total_tokens, ttl, db_path=None):
+        self._chats = OrderedDict()
+        self._token_budget = token_budget
+        self._max_messages = max_messages
+        self._max_chats = max_chats
+        self._max_total_tokens = max_total_tokens
+        self._ttl = ttl
+        self.total_tokens = 0
+        self._db = None
+        if db_path:
+            self._db = SQLiteBackend(db_path, [
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, mode TEXT, chat_id INTEGER, role TEXT, content TEXT)",
+                "CREATE INDEX IF NOT EXISTS messages_chat ON messages (mode, chat_id, id)",
+            ])
+
+    def __len__(self):
+        return len(self._chats)
+
+    def _db_load(self, db, mode, chat_id):
+        rows = db.execute(
+            "SELECT role, content FROM messages WHERE mode = ? AND chat_id = ? ORDER BY id DESC LIMIT ?",
+            (mode, chat_id, self._max_messages),
+        ).fetchall()
+        return reversed(rows)
+
+    def _db_append(self, db, mode, chat_id, role, content):
+        db.execute(
+            "INSERT INTO messages (mode, chat_id, role, content) VALUES (?, ?, ?, ?)",
+            (mode, chat_id, role, content),
+        )
+        # На диске держим не больше, чем помещается в кольцевой буфер
+        db.execute(
+            "DELETE FROM messages WHERE mode = ? AND chat_id = ? AND id <= ("
+            "SELECT id FROM messages WHERE mode = ? AND chat_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+            (mode, chat_id, mode, chat_id, self._max_messages),
+        )
+        db.commit()
+
+    def _push(self, conversation, role, content):
+        if len(conversation.messages) == conversation.messages.maxlen:
+            self._pop_oldest(conversation)
+        tokens = estimate_tokens(content)
+        conversation.messages.append((role, content, tokens))
+        conversation.tokens += tokens
+        self.total_tokens += tokens
+        while conversation.tokens > self._token_budget and len(conversation.messages) > 1:
+            self._pop_oldest(conversation)
+
+    def _pop_oldest(self, conversation):
+        _, _, tokens = conversation.messages.popleft()
+        conversation.tokens -= tokens
+        self.total_tokens -= tokens
+
+    def _evict(self):
+        now = time.monotonic()
+        while self._chats:
+            key, conversation = next(iter(self._chats.items()))
+            expired = now - conversation.touched > self._ttl
+            if not expired and len(self._chats) <= self._max_chats and self.total_tokens <= self._max_total_tokens:
+                break
+            del self._chats[key]
+            self.total_tokens -= conversation.tokens
+
+    async def _conversation(self, chat_id, mode):
+        key = (mode, chat_id)
+        conversation = self._chats.get(key)
+        if conversation is None:
+            conversation = _Conversation(self._max_messages)
+            if self._db is not None:
+                for role, content in await self._db.run(self._db_load, mode, chat_id):
+                    self._push(conversation, role, content)
+            self._chats[key] = conversation
+        else:
+            self._chats.move_to_end(key)
+        conversation.touched = time.monotonic()
+        return conversation
+
+    async def get_messages(self, chat_id, mode):
+        """Сообщения диалога в формате OpenAI, уже уложенные в бюджет токенов."""
+        conversation = await self._conversation(chat_id, mode)
+        self._evict()
+        return [{"role": role, "content": content} for role, content, _ in conversation.messages]
+
+    async def append(self, chat_id, mode, role, content):
+        conversation = await self._conversation(chat_id, mode)
+        self._push(conversation, role, content)
+        self._evict()
+        if self._db is not None:
+            await self._db.run(self._db_append, mode, chat_id, role, content)
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+
+
+conversation_store = ConversationStore(
+    token_budget=HISTORY_TOKEN_BUDGET,
+    max_messages=HISTORY_MAX_MESSAGES,
+    max_chats=HISTORY_MAX_CHATS,
+    max_total_tokens=HISTORY_MAX_TOTAL_TOKENS,
+    ttl=HISTORY_TTL,
+    db_path=HISTORY_DB_PATH,
+)
+
+# === Общая HTTP-сессия ===
+_http_session = None
+
+
+def get_http_session():
+    """Одна aiohttp-сессия с пулом соединений на весь процесс (скачивание картинок и т.п.)."""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=OPENAI_MEDIA_TIMEOUT),
+            connector=aiohttp.TCPConnector(limit=OPENAI_MAX_IN_FLIGHT),
+        )
+    return _http_session
+
+
+async def close_http_session():
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+
+
+async def fetch_bytes(url):
+    async with get_http_session().get(url) as resp:
+        resp.raise_for_status()
+        return await resp.read()
+
+
+# === Кэш изображений ===
+class ImageCache:
+    """
+    Готовые картинки на диске по хэшу промпта (LRU по времени доступа, общий лимит размера)
+    и file_id Telegram для повторной отправки без загрузки байтов.
+    Работа с диском идёт в одном фоновом потоке, чтобы чтение и вытеснение не гонялись между собой.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="image-cache")
+
+    @staticmethod
+    def make_key(prompt, params, variants):
+        return sha256_hex(json.dumps([normalize_text(prompt), params, variants], sort_keys=True, ensure_ascii=False))
+
+    def _path(self, key, suffix):
+        return os.path.join(self._directory, f"{key}{suffix}")
+
+    def _load(self, key):
+        index_path = self._path(key, ".json")
+        # Файлы могут исчезнуть в любой момент (вытеснение, другой процесс) — это просто промах
+        try:
+            with open(index_path, encoding="utf-8") as f:
+                entry = json.load(f)
+            paths = [self._path(key, f"_{index}.png") for index in range(entry["count"])]
+            images = []
+            for path in paths:
+                with open(path, "rb") as f:
+                    images.append(f.read())
+            now = time.time()
+            for path in [index_path] + paths:
+                os.utime(path, (now, now))
+        except FileNotFoundError:
+            return None
+        return images, entry.get("file_ids")
+
+    def _store(self, key, images, file_ids):
+        # Каталог создаётся при первой записи, а не при импорте модуля
+        os.makedirs(self._directory, exist_ok=True)
+        for index, image in enumerate(images):
+            with open(self._path(key, f"_{index}.png"), "wb") as f:
+                f.write(image)
+        tmp_path = self._path(key, ".json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"count": len(images), "file_ids": file_ids}, f)
+        os.replace(tmp_path, self._path(key, ".json"))
+        self._evict()
+
+    def _evict(self):
+        files = []
+        for entry in os.scandir(self._directory):
+            try:
+                if entry.is_file():
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+            except FileNotFoundError:
+                continue
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self._max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def get(self, key):
+        """Возвращает (список байтов, список file_id или None) либо None. Ошибка диска — это промах."""
+        try:
+            return await self._run(self._load, key)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Не удалось прочитать кэш изображений: {e}")
+            return None
+
+    async def put(self, key, images, file_ids=None):
+        """Сохраняет картинки; ошибка записи не должна ломать запрос, который уже выполнен."""
+        try:
+            await self._run(self._store, key, images, file_ids)
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить картинки в кэш: {e}")
+
+    def close(self):
+        self._executor.shutdown()
+
+
+image_cache = ImageCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES)
+
+
+# === Кэш ответов ===
+def normalize_keywords(text):
+    """Список ключевых слов без учёта регистра, повторов и порядка."""
+    keywords = {" ".join(word.split()) for word in re.split(r"[,;\n]+", text.casefold())}
+    return ", ".join(sorted(keyword for keyword in keywords if keyword))
+
+
+def normalize_text(text):
+    return " ".join(text.casefold().split())
+
+
+def sha256_hex(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Кэш готовых ответов для режимов, где результат почти не зависит от собеседника (SEO, Помощница).
+    В памяти — LRU с TTL, при заданном `db_path` — второй уровень в SQLite. Ведёт счётчики попаданий.
+    """
+
+    def __init__(self, max_size, ttl, db_path=None, disk_max_size=0):
+        self._entries = OrderedDict()
+        self._max_size = max_size
+        self._ttl = ttl
+        self._disk_max_size = disk_max_size
+        self.hits = 0
+        self.misses = 0
+        self._db = None
+        if db_path:
+            self._db = SQLiteBackend(db_path, [
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT, expires REAL)",
+                "CREATE INDEX IF NOT EXISTS responses_expires ON responses (expires)",
+            ])
+
+    @staticmethod
+    def make_key(mode, system_prompt, params, normalized_input):
+        return sha256_hex(json.dumps(
+            [mode, sha256_hex(system_prompt), params, normalized_input], sort_keys=True, ensure_ascii=False
+        ))
+
+    def _db_get(self, db, key):
+        row = db.execute("SELECT value, expires FROM responses WHERE key = ?", (key,)).fetchone()
+        return row
+
+    def _db_set(self, db, key, value, expires):
+        db.execute("INSERT OR REPLACE INTO responses (key, value, expires) VALUES (?, ?, ?)", (key, value, expires))
+        db.execute("DELETE FROM responses WHERE expires < ?", (time.time(),))
+        db.execute(
+            "DELETE FROM responses WHERE key IN ("
+            "SELECT key FROM responses ORDER BY expires DESC LIMIT -1 OFFSET ?)",
+            (self._disk_max_size,),
+        )
+        db.commit()
+
+    def _remember(self, key, value, expires):
+        self._entries[key] = (value, expires)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    async def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None and self._db is not None:
+            entry = await self._db.run(self._db_get, key)
+            if entry is not None:
+                self._remember(key, *entry)
+        if entry is None or entry[1] < time.time():
+            self._entries.pop(key, None)
+            self.misses += 1
+            metrics.inc("bot_response_cache_misses_total")
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        metrics.inc("bot_response_cache_hits_total")
+        return entry[0]
+
+    async def set(self, key, value):
+        expires = time.time() + self._ttl
+        self._remember(key, value, expires)
+        if self._db is not None:
+            await self._db.run(self._db_set, key, value, expires)
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+
+
+response_cache = ResponseCache(
+    max_size=RESPONSE_CACHE_SIZE,
+    ttl=RESPONSE_CACHE_TTL,
+    db_path=RESPONSE_CACHE_DB_PATH,
+    disk_max_size=RESPONSE_CACHE_DISK_SIZE,
+)
+
+# === Расшифровка голосовых ===
+async def transcribe_voice(update, voice_bytes, duration):
+    """Короткие записи — одним запросом к Whisper, длинные — по кускам параллельно."""
+    if duration <= VOICE_CHUNK_THRESHOLD and len(voice_bytes) <= WHISPER_MAX_BYTES:
+        audio_file = await prepare_voice_for_whisper(voice_bytes)
+        async with fair_slot(update, "transcription"):
+            transcript = await openai_gateway.transcribe(model="whisper-1", file=audio_file)
+        return transcript.text
+    return await transcribe_long_voice(update, voice_bytes, duration)
+
+
+async def transcribe_long_voice(update, voice_bytes, duration):
+    """
+    Режет запись по паузам, сжимает куски и расшифровывает их параллельно (не больше
+    VOICE_CHUNK_PARALLELISM сразу). Каждый запрос к Whisper занимает свой слот очереди "transcription",
+    так что SCHEDULER_TRANSCRIPTION_SLOTS соблюдается. Готовое начало расшифровки показывается по ходу работы.
+    """
+    chunks = plan_chunks(duration, await detect_silences(voice_bytes), VOICE_CHUNK_SECONDS)
+    placeholder = await update.message.reply_text(f"🎧 Расшифровываю длинное голосовое (0/{len(chunks)})...")
+    semaphore = asyncio.Semaphore(VOICE_CHUNK_PARALLELISM)
+    texts = [None] * len(chunks)
+    loop = asyncio.get_running_loop()
+    next_edit = 0.0
+    shown_done = 0
+
+    async def transcribe_chunk(index, start, end):
+        async with semaphore:
+            chunk_bytes = await compress_chunk(voice_bytes, start, end)
+            # О месте в очереди не пишем: прогресс и так виден в сообщении-заглушке
+            async with fair_slot(update, "transcription", notify_user=False):
+                transcript = await openai_gateway.transcribe(model="whisper-1", file=(f"chunk{index}.ogg", chunk_bytes))
+        texts[index] = transcript.text.strip()
+
+    tasks = [asyncio.create_task(transcribe_chunk(index, start, end)) for index, (start, end) in enumerate(chunks)]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            await finished
+            done = sum(text is not None for text in texts)
+            if done in (shown_done, len(texts)) or loop.time() < next_edit:
+                continue
+            shown_done = done
+            next_edit = loop.time() + STREAM_EDIT_INTERVAL
+            ready = " ".join(itertools.takewhile(lambda text: text is not None, texts))
+            try:
+                await safe_edit_text(
+                    placeholder,
+                    f"🎧 Расшифровано {done}/{len(chunks)}:\n\n{ready}"[:TELEGRAM_MESSAGE_LIMIT - 1] + "…",
+                )
+            except telegram.error.TelegramError as e:
+                logger.warning(f"Не удалось показать частичную расшифровку: {e}")
+    except Exception:
+        try:
+            await safe_edit_text(placeholder, "⚠️ Не удалось расшифровать голосовое.")
+        except telegram.error.TelegramError as e:
+            logger.warning(f"Не удалось отметить ошибку расшифровки: {e}")
+        raise
+    finally:
+        for task in tasks:
+            task.cancel()
+    transcript = " ".join(text for text in texts if text)
+    # Расшифровка уже готова и оплачена — сбой правки не должен её терять
+    try:
+        await safe_edit_text(placeholder, f"🎧 Расшифровка:\n\n{transcript}"[:TELEGRAM_MESSAGE_LIMIT])
+    except telegram.error.TelegramError as e:
+        logger.warning(f"Не удалось показать расшифровку: {e}")
+    return transcript
+
+
+# === Обработчики режимов ===
+async def run_completion_mode(update: Update, context: ContextTypes.DEFAULT_TYPE, mode, text):
+    """
+    Одиночный запрос к GPT: SEO, Помощница, Олеся. Кэширует ответ, если у режима есть нормализатор.
+    Ответ из кэша не расходует лимит пользователя и не занимает место в очереди к OpenAI.
+    """
+    try:
+        messages = [
+            {"role": "system", "content": mode.system_prompt},
+            {"role": "user", "content": mode.user_template.format(text=text)}
+        ]
+        cache_key = None
+        result = None
+        if mode.normalize_input:
+            cache_key = ResponseCache.make_key(mode.key, mode.system_prompt, mode.params, mode.normalize_input(text))
+            result = await response_cache.get(cache_key)
+        if result is None and not await check_rate_limit(update, mode.budget):
+            return
+        placeholder = await update.message.reply_text(mode.ack_text)
+        await update.message.chat.send_action(action=ChatAction.TYPING)
+        if result is None:
+            if mode.render_partial:
+                deltas = scheduled_stream(update, mode.budget, openai_gateway.chat_stream(messages=messages, **mode.params))
+                result = await stream_into_message(placeholder, deltas, mode.render_partial, mode.parse_mode)
+            else:
+                async with fair_slot(update, mode.budget):
+                    response = await openai_gateway.chat(messages=messages, **mode.params)
+                result = response.choices[0].message.content
+            result = result.strip()
+            if cache_key:
+                await response_cache.set(cache_key, result)
+        formatted, plain = mode.format_reply(result)
+        if mode.render_partial:
+            await finish_streamed_reply(placeholder, formatted, mode.parse_mode, plain)
+        else:
+            with metrics.stage("telegram_reply"):
+                await update.message.reply_text(formatted, parse_mode=mode.parse_mode)
+    except Exception as e:
+        logger.error(f"{mode.error_log}: {e}")
+        await update.message.reply_text(mode.error_text)
+
+
+async def generate_image_variants(update, prompt, params, variants):
+    """
+    Варианты генерируются параллельно (у dall-e-3 n=1), каждый в своём слоте очереди "image",
+    байты скачиваются через общую сессию.
+    """
+    async def generate_variant(index):
+        # О месте в очереди сообщаем один раз на запрос, а не на каждый вариант
+        async with fair_slot(update, "image", notify_user=index == 0):
+            return await openai_gateway.generate_image(prompt=prompt, n=1, **params)
+
+    responses = await asyncio.gather(*(generate_variant(index) for index in range(variants)), return_exceptions=True)
+    urls = [response.data[0].url for response in responses if not isinstance(response, BaseException)]
+    if not urls:
+        raise responses[0]
+    with metrics.stage("image_download"):
+        return await asyncio.gather(*(fetch_bytes(url) for url in urls))
+
+
+async def send_images(message, photos, caption):
+    """Отправляет одно фото или медиагруппу; возвращает file_id отправленных фото."""
+    with metrics.stage("telegram_reply"):
+        if len(photos) == 1:
+            sent = [await message.reply_photo(photo=photos[0], caption=caption)]
+        else:
+            sent = await message.reply_media_group(media=[
+                InputMediaPhoto(media=photo, caption=caption if index == 0 else None)
+                for index, photo in enumerate(photos)
+            ])
+    return [sent_message.photo[-1].file_id for sent_message in sent]
+
+
+async def run_image_mode(update: Update, context: ContextTypes.DEFAULT_TYPE, mode, text):
+    try:
+        cache_key = ImageCache.make_key(text, mode.params, IMAGE_VARIANTS)
+        cached = await image_cache.get(cache_key)
+        if cached is None and not await check_rate_limit(update, mode.budget, cost=IMAGE_VARIANTS):
+            return
+        await update.message.reply_text(mode.ack_text)
+        await update.message.chat.send_action(action=ChatAction.UPLOAD_PHOTO)
+        if cached is not None:
+            images, file_ids = cached
+            metrics.inc("bot_image_cache_hits_total")
+            caption = "Ваше изображение готово!" if len(images) == 1 else "Ваши изображения готовы!"
+            if file_ids:
+                try:
+                    await send_images(update.message, file_ids, caption)
+                    return
+                except telegram.error.BadRequest as e:
+                    logger.warning(f"Сохранённые file_id не подошли, отправляю файлы заново. Ошибка: {e}")
+            file_ids = await send_images(update.message, images, caption)
+            await image_cache.put(cache_key, images, file_ids)
+            return
+        metrics.inc("bot_image_cache_misses_total")
+        images = await generate_image_variants(update, text, mode.params, IMAGE_VARIANTS)
+        caption = "Ваше изображение готово!" if len(images) == 1 else "Ваши изображения готовы!"
+        file_ids = await send_images(update.message, images, caption)
+        await image_cache.put(cache_key, images, file_ids)
+    except Exception as e:
+        logger.error(f"{mode.error_log}: {e}")
+        await update.message.reply_text(mode.error_text)
+
+
+async def run_chat_mode(update: Update, context: ContextTypes.DEFAULT_TYPE, mode, text):
+    """Режимы чата (Психолог, Астролог, Default) с памятью диалога."""
+    if not await check_rate_limit(update, mode.budget):
+        return
+    chat_id = update.effective_chat.id
+    await conversation_store.append(chat_id, mode.key, "user", text)
+    messages = [{"role": "system", "content": mode.system_prompt}] + await conversation_store.get_messages(chat_id, mode.key)
+    try:
+        await update.message.chat.send_action(action=ChatAction.TYPING)
+        placeholder = await update.message.reply_text("…", reply_markup=MAIN_KEYBOARD)
+        deltas = scheduled_stream(update, mode.budget, openai_gateway.chat_stream(messages=messages, **mode.params))
+        bot_reply = await stream_into_message(placeholder, deltas, mode.render_partial, mode.parse_mode)
+        await conversation_store.append(chat_id, mode.key, "assistant", bot_reply)
+        await finish_streamed_reply(placeholder, bot_reply, mode.parse_mode)
+    except Exception as e:
+        logger.error(f"{mode.error_log}: {e}")
+        await update.message.reply_text(mode.error_text)
+
+
+def render_partial_html(partial):
+    return close_open_html_tags(trim_partial_html(partial)) + STREAM_CURSOR
+
+
+def render_partial_seo(partial):
+    return f"✍️ *Пишу текст\\.\\.\\.*\n\n```\n{escape_markdown_code(partial)}\n```"
+
+
+def format_as_is(text):
+    return text, None
+
+
+def format_seo_reply(seo_text):
+    formatted = (
+        f"✅ *Готово\\!* \n\n"
+        f"Длина текста: {len(seo_text)} символов\\.\n\n"
+        f"```\n{escape_markdown_code(seo_text)}\n```"
+    )
+    plain = f"✅ Готово!\n\nДлина текста: {len(seo_text)} символов.\n\n{seo_text}"
+    return formatted, plain
+
+
+def format_assistant_reply(assistant_reply):
+    formatted = (
+        f"✅ *Ответ от Евгении Ланцовой готов:*\n\n"
+        f"```\n{escape_markdown_code(assistant_reply)}\n```"
+    )
+    return formatted, assistant_reply
+
+
+# === Реестр режимов ===
+@dataclass(frozen=True)
+class Mode:
+    """
+    Описание режима: кнопка меню, промпт, параметры модели и оформление ответа.
+    Всё вычисляется один раз при импорте; новый режим — это новая запись в MODES.
+    """
+    key: str
+    handler: Callable
+    button: Optional[str] = None
+    activation_text: str = ""
+    activation_keyboard: bool = False
+    ack_text: str = ""
+    system_prompt: str = ""
+    user_template: str = "{text}"
+    params: dict = field(default_factory=dict)
+    parse_mode: Optional[str] = None
+    render_partial: Optional[Callable] = None
+    format_reply: Callable = format_as_is
+    normalize_input: Optional[Callable] = None
+    budget: str = "chat"
+    error_log: str = "Ошибка ответа OpenAI"
+    error_text: str = "Произошла ошибка."
+
+
+CHAT_PARAMS = {"model": "gpt-4o", "temperature": 0.7, "max_tokens": 1500}
+
+MODES = {mode.key: mode for mode in (
+    Mode(
+        key="default",
+        handler=run_chat_mode,
+        button="🔙 Назад в главное меню",
+        activation_text="Вы вернулись в главное меню.",
+        activation_keyboard=True,
+        system_prompt="Ты — дружелюбный и полезный ассистент. Используй HTML-теги для форматирования: <b> для жирного, <i> для курсива.",
+        params=CHAT_PARAMS,
+        parse_mode='HTML',
+        render_partial=render_partial_html,
+    ),
+    Mode(
+        key="seo",
+        handler=run_completion_mode,
+        button="📈 SEO",
+        activation_text="Режим SEO активирован. Отправьте мне список ключевых слов для описания товара.",
+        ack_text="✅ Принял. Генерирую SEO-текст...",
+        system_prompt=(
+            "Ты — опытный SEO-специалист и копирайтер для маркетплейсов. "
+            "Твоя задача — сгенерировать продающий, хорошо структурированный и SEO-оптимизированный текст для карточки товара на Wildberries. "
+            "Текст должен быть объемом строго от 1500 до 2000 символов. "
+            "Обязательно используй предоставленные ключевые слова органично и естественно, распределяя их по всему тексту. "
+            "Не используй Markdown или HTML теги в ответе, только обычный текст."
+        ),
+        user_template="Сгенерируй описание товара, используя следующие ключевые слова: {text}",
+        params={"model": "gpt-4o", "temperature": 0.7, "max_tokens": 800},
+        parse_mode='MarkdownV2',
+        render_partial=render_partial_seo,
+        format_reply=format_seo_reply,
+        normalize_input=normalize_keywords,
+        error_log="Ошибка при генерации SEO-текста",
+        error_text="❌ Произошла ошибка при генерации SEO-текста.",
+    ),
+    Mode(
+        key="assistant",
+        handler=run_completion_mode,
+        button="💁‍♀️ Помощница",
+        activation_text="Режим Помощницы активирован. Пришлите мне отзыв или вопрос клиента для подготовки ответа.",
+        ack_text="✅ Готовлю ответ от имени менеджера...",
+        system_prompt=(
+            "Ты — Евгения Ланцова, менеджер по заботе о клиентах в компании 'Немецкий дом'. "
+            "Твоя задача — отвечать на отзывы и вопросы клиентов максимально вежливо, профессионально и понятно. "
+            "В конце КАЖДОГО ответа, без каких-либо исключений, ты ОБЯЗАНА добавить следующую подпись на трех отдельных строках:\n"
+            "Ваш \"Немецкий дом\"\n"
+            "Менеджер заботы о клиентах\n"
+            "Евгения Ланцова"
+        ),
+        user_template="Вот отзыв/вопрос клиента, на который нужно ответить:\n\n---\n\n{text}",
+        params={"model": "gpt-4o", "temperature": 0.5, "max_tokens": 500},
+        parse_mode='MarkdownV2',
+        format_reply=format_assistant_reply,
+        normalize_input=normalize_text,
+        error_log="Ошибка при генерации ответа на отзыв",
+        error_text="❌ Произошла ошибка при генерации ответа.",
+    ),
+    Mode(
+        key="olesya",
+        handler=run_completion_mode,
+        button="🧘‍♀️ Олеся",
+        activation_text="Режим Олеси активирован. Отправьте мне тему или идею для поста, и я напишу текст в ее стиле.",
+        ack_text="✅ Поняла. Пишу пост от имени Олеси...",
+        system_prompt=(
+            "Ты — Олеся, 42-летняя женщина, духовный наставник и энергопрактик. "
+            "Ты веришь в реинкарнацию, кармические задачи, силу рода и единство всех религий в любви и благодарности. "
+            "Твой основной метод — работа с телом, энергиями и тантрой для исцеления психологических и телесных травм, в обход традиционной психологии. "
+            "Твой стиль письма — мягкий, мудрый, вдохновляющий и очень личный. Ты обращаешься в основном к женщинам, используя слова 'дорогие', 'любимые', 'прекрасные'. "
+            "Твоя задача — написать пост для твоего канала на заданную тему. Пост должен раскрывать пользу работы с телом и энергиями, помогать читательницам принять себя и открыть сердце для любви. "
+            "Твоя цель — вдохновить их на развитие через любовь, а не через страх. "
+            "Используй абзацы для лучшей читаемости. Для форматирования используй ТОЛЬКО HTML-теги <b> для жирного текста и <i> для курсива. Другие теги, такие как <h1>, использовать запрещено."
+        ),
+        user_template="Напиши, пожалуйста, пост на следующую тему: {text}",
+        params={"model": "gpt-4o", "temperature": 0.8, "max_tokens": 1500},
+        parse_mode='HTML',
+        render_partial=render_partial_html,
+        error_log="Ошибка при генерации поста от имени Олеси",
+        error_text="❌ Произошла ошибка при генерации поста.",
+    ),
+    Mode(
+        key="image",
+        handler=run_image_mode,
+        button="🌍 Изображение",
+        activation_text="Режим генерации изображений активирован. Напишите, что вы хотите создать.",
+        ack_text="🎨 Создаю изображение...",
+        params={"model": "dall-e-3", "size": "1024x1024", "quality": "standard"},
+        budget="image",
+        error_log="Ошибка генерации изображения",
+        error_text="Не удалось создать изображение.",
+    ),
+    Mode(
+        key="psychologist",
+        handler=run_chat_mode,
+        button="💬 Психолог",
+        activation_text="🧠 Я вас слушаю...",
+        system_prompt="Ты — эмпатичный психолог. Используй HTML-теги для форматирования: <b> для акцентов, <i> для мягких выделений.",
+        params=CHAT_PARAMS,
+        parse_mode='HTML',
+        render_partial=render_partial_html,
+    ),
+    Mode(
+        key="astrologer",
+        handler=run_chat_mode,
+        button="🔮 Астролог",
+        activation_text="✨ Задайте свой вопрос.",
+        system_prompt="Ты — опытный астролог. Используй HTML-теги для форматирования: <b> для важных терминов, <i> для названий.",
+        params=CHAT_PARAMS,
+        parse_mode='HTML',
+        render_partial=render_partial_html,
+    ),
+)}
+MODES_BY_BUTTON = {mode.button: mode for mode in MODES.values() if mode.button}
+
+KEYBOARD_LAYOUT = [
+    ["seo", "image"],
+    ["assistant", "olesya"],
+    ["psychologist", "astrologer"],
+    ["default"],
+]
+MAIN_KEYBOARD = ReplyKeyboardMarkup(
+    [[KeyboardButton(MODES[key].button) for key in row] for row in KEYBOARD_LAYOUT],
+    resize_keyboard=True
+)
+
+
+def resolve_mode(text, current_key):
+    """Возвращает (режим, нажата_ли_кнопка) за один поиск в словаре."""
+    selected = MODES_BY_BUTTON.get(text)
+    if selected is not None:
+        return selected, True
+    return MODES.get(current_key, MODES["default"]), False
 
 # === Обработчики команд ===
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "😊 Привет! Я ваш многофункциональный ассистент с GPT-4o.\n\n"
         "Выберите один из режимов в меню ниже.",
-        reply_markup=build_keyboard()
+        reply_markup=MAIN_KEYBOARD
     )
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -118,231 +1798,175 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "💬 **Психолог** - выслушаю и поддержу.\n"
         "🔮 **Астролог** - дам совет.\n\n"
         "Я также умею расшифровывать голосовые сообщения!",
-        reply_markup=build_keyboard()
+        reply_markup=MAIN_KEYBOARD
     )
 
 # === Обработчики сообщений ===
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ogg_path = None
-    mp3_path = None
+    current_mode.set("voice")
+    if not await check_rate_limit(update, "transcription", max(1, as_seconds(update.message.voice.duration))):
+        return
     try:
-        file_id = update.message.voice.file_id
-        voice_file = await context.bot.get_file(file_id)
-        ogg_path = f"voice_{file_id}.ogg"
-        mp3_path = f"voice_{file_id}.mp3"
-        await voice_file.download_to_drive(ogg_path)
+        with metrics.stage("telegram_download"):
+            file_id = update.message.voice.file_id
+            voice_file = await context.bot.get_file(file_id)
+            voice_bytes = bytes(await voice_file.download_as_bytearray())
         await update.message.chat.send_action(action=ChatAction.TYPING)
-        process = await asyncio.create_subprocess_exec(
-            FFMPEG_PATH, "-i", ogg_path, "-y", mp3_path,
-            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
-        )
-        await process.communicate()
-        if process.returncode != 0:
-            raise subprocess.CalledProcessError(process.returncode, cmd=FFMPEG_PATH)
-        with open(mp3_path, "rb") as audio_file:
-            transcript = client.audio.transcriptions.create(model="whisper-1", file=audio_file)
-        update.message.text = transcript.text
-        await handle_message(update, context)
+        transcript = await transcribe_voice(update, voice_bytes, as_seconds(update.message.voice.duration))
+        await process_text(update, context, transcript)
     except Exception as e:
         logger.error(f"Ошибка в handle_voice: {e}")
         await update.message.reply_text("❌ Произошла ошибка при обработке аудио.")
-    finally:
-        if ogg_path and os.path.exists(ogg_path): os.remove(ogg_path)
-        if mp3_path and os.path.exists(mp3_path): os.remove(mp3_path)
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.effective_chat.id
-    text = update.message.text.strip()
-    mode = context.user_data.get("mode", "default")
-    
+    await process_text(update, context, update.message.text)
+
+async def process_text(update: Update, context: ContextTypes.DEFAULT_TYPE, text):
+    text = text.strip()
+    mode, switched = resolve_mode(text, context.user_data.get("mode", "default"))
+    current_mode.set(mode.key)
+
     # === Навигация по меню (переключение режимов) ===
-    if text == "🔙 Назад в главное меню":
-        context.user_data["mode"] = "default"
-        await update.message.reply_text("Вы вернулись в главное меню.", reply_markup=build_keyboard())
-        return
-    if text == "📈 SEO":
-        context.user_data["mode"] = "seo"
-        await update.message.reply_text(
-            "Режим SEO активирован. Отправьте мне список ключевых слов для описания товара."
-        )
-        return
-    if text == "💁‍♀️ Помощница":
-        context.user_data["mode"] = "assistant"
+    if switched:
+        context.user_data["mode"] = mode.key
         await update.message.reply_text(
-            "Режим Помощницы активирован. Пришлите мне отзыв или вопрос клиента для подготовки ответа."
+            mode.activation_text, reply_markup=MAIN_KEYBOARD if mode.activation_keyboard else None
         )
         return
-    if text == "🧘‍♀️ Олеся":
-        context.user_data["mode"] = "olesya"
-        await update.message.reply_text(
-            "Режим Олеси активирован. Отправьте мне тему или идею для поста, и я напишу текст в ее стиле."
-        )
-        return
-    if text == "🌍 Изображение":
-        context.user_data["mode"] = "image"
-        await update.message.reply_text("Режим генерации изображений активирован. Напишите, что вы хотите создать.")
-        return
-    if text == "💬 Психолог":
-        context.user_data["mode"] = "psychologist"
-        await update.message.reply_text("🧠 Я вас слушаю...")
-        return
-    if text == "🔮 Астролог":
-        context.user_data["mode"] = "astrologer"
-        await update.message.reply_text("✨ Задайте свой вопрос.")
-        return
 
-    # === Логика для каждого активного режима ===
-    if mode == "olesya":
-        post_topic = text
-        await update.message.reply_text("✅ Поняла. Пишу пост от имени Олеси...")
-        await update.message.chat.send_action(action=ChatAction.TYPING)
-        try:
-            olesya_system_prompt = (
-                "Ты — Олеся, 42-летняя женщина, духовный наставник и энергопрактик. "
-                "Ты веришь в реинкарнацию, кармические задачи, силу рода и единство всех религий в любви и благодарности. "
-                "Твой основной метод — работа с телом, энергиями и тантрой для исцеления психологических и телесных травм, в обход традиционной психологии. "
-                "Твой стиль письма — мягкий, мудрый, вдохновляющий и очень личный. Ты обращаешься в основном к женщинам, используя слова 'дорогие', 'любимые', 'прекрасные'. "
-                "Твоя задача — написать пост для твоего канала на заданную тему. Пост должен раскрывать пользу работы с телом и энергиями, помогать читательницам принять себя и открыть сердце для любви. "
-                "Твоя цель — вдохновить их на развитие через любовь, а не через страх. "
-                "Используй абзацы для лучшей читаемости. Для форматирования используй ТОЛЬКО HTML-теги <b> для жирного текста и <i> для курсива. Другие теги, такие как <h1>, использовать запрещено."
-            )
-            messages = [
-                {"role": "system", "content": olesya_system_prompt},
-                {"role": "user", "content": f"Напиши, пожалуйста, пост на следующую тему: {post_topic}"}
-            ]
-            response = client.chat.completions.create(
-                model="gpt-4o", messages=messages, temperature=0.8, max_tokens=1500
-            )
-            post_text = response.choices[0].message.content.strip()
-            
-            try:
-                await update.message.reply_text(post_text, parse_mode='HTML')
-            except telegram.error.BadRequest as e:
-                if 'entities' in str(e):
-                    logger.warning(f"Ошибка парсинга HTML, отправляю текст без форматирования. Ошибка: {e}")
-                    await update.message.reply_text(post_text)
-                else:
-                    raise e
-        except Exception as e:
-            logger.error(f"Ошибка при генерации поста от имени Олеси: {e}")
-            await update.message.reply_text("❌ Произошла ошибка при генерации поста.")
-        return
+    # === Логика активного режима ===
+    # Лимит и очередь к OpenAI проверяет сам обработчик: ответ из кэша их не расходует
+    await mode.handler(update, context, mode, text)
 
-    if mode == "assistant":
-        customer_feedback = text
-        await update.message.reply_text("✅ Готовлю ответ от имени менеджера...")
-        await update.message.chat.send_action(action=ChatAction.TYPING)
-        try:
-            assistant_system_prompt = (
-                "Ты — Евгения Ланцова, менеджер по заботе о клиентах в компании 'Немецкий дом'. "
-                "Твоя задача — отвечать на отзывы и вопросы клиентов максимально вежливо, профессионально и понятно. "
-                "В конце КАЖДОГО ответа, без каких-либо исключений, ты ОБЯЗАНА добавить следующую подпись на трех отдельных строках:\n"
-                "Ваш \"Немецкий дом\"\n"
-                "Менеджер заботы о клиентах\n"
-                "Евгения Ланцова"
-            )
-            messages = [
-                {"role": "system", "content": assistant_system_prompt},
-                {"role": "user", "content": f"Вот отзыв/вопрос клиента, на который нужно ответить:\n\n---\n\n{customer_feedback}"}
-            ]
-            response = client.chat.completions.create(
-                model="gpt-4o", messages=messages, temperature=0.5, max_tokens=500
-            )
-            assistant_reply = response.choices[0].message.content.strip()
-            final_response = (
-                f"✅ *Ответ от Евгении Ланцовой готов:*\n\n"
-                f"```\n{assistant_reply}\n```"
-            )
-            await update.message.reply_text(final_response, parse_mode='MarkdownV2')
-        except Exception as e:
-            logger.error(f"Ошибка при генерации ответа на отзыв: {e}")
-            await update.message.reply_text("❌ Произошла ошибка при генерации ответа.")
-        return
+# === Вебхук ===
+def build_web_app(application, secret_token=WEBHOOK_SECRET, queue_size=WEBHOOK_QUEUE_SIZE, webhook=True):
+    """
+    aiohttp-приложение для приёма апдейтов. Апдейт сразу подтверждается ответом 200 и уходит
+    в очередь Application; при переполненной очереди отвечаем 503, и Telegram повторит доставку позже.
+    /healthz и /metrics доступны всегда; с `webhook=False` поднимаются только они.
+    """
+    update_processor = application.update_processor
+    backlog_limit = getattr(update_processor, "backlog_limit", None)
+    # Отказываем раньше, чем процессор начнёт отбрасывать уже подтверждённые апдейты
+    if backlog_limit is not None:
+        queue_size = min(queue_size, backlog_limit)
 
-    if mode == "seo":
-        keywords = text
-        await update.message.reply_text("✅ Принял. Генерирую SEO-текст...")
-        await update.message.chat.send_action(action=ChatAction.TYPING)
-        try:
-            seo_system_prompt = (
-                "Ты — опытный SEO-специалист и копирайтер для маркетплейсов. "
-                "Твоя задача — сгенерировать продающий, хорошо структурированный и SEO-оптимизированный текст для карточки товара на Wildberries. "
-                "Текст должен быть объемом строго от 1500 до 2000 символов. "
-                "Обязательно используй предоставленные ключевые слова органично и естественно, распределяя их по всему тексту. "
-                "Не используй Markdown или HTML теги в ответе, только обычный текст."
-            )
-            messages = [
-                {"role": "system", "content": seo_system_prompt},
-                {"role": "user", "content": f"Сгенерируй описание товара, используя следующие ключевые слова: {keywords}"}
-            ]
-            response = client.chat.completions.create(
-                model="gpt-4o", messages=messages, temperature=0.7, max_tokens=800
-            )
-            seo_text = response.choices[0].message.content.strip()
-            final_response = (
-                f"✅ *Готово\\!* \n\n"
-                f"Длина текста: {len(seo_text)} символов\\.\n\n"
-                f"```\n{seo_text}\n```"
-            )
-            await update.message.reply_text(final_response, parse_mode='MarkdownV2')
-        except Exception as e:
-            logger.error(f"Ошибка при генерации SEO-текста: {e}")
-            await update.message.reply_text("❌ Произошла ошибка при генерации SEO-текста.")
-        return
+    def pending_updates():
+        if hasattr(update_processor, "reserve"):
+            # Принятые, но ещё не дошедшие до процессора апдейты учтены в reserved
+            return update_processor.reserved + update_processor.backlog
+        return application.update_queue.qsize() + getattr(update_processor, "backlog", 0)
 
-    if mode == "image":
-        await update.message.reply_text("🎨 Создаю изображение...")
-        await update.message.chat.send_action(action=ChatAction.UPLOAD_PHOTO)
+    async def telegram_webhook(request):
+        received_secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(received_secret, secret_token):
+            return web.Response(status=403)
+        if pending_updates() >= queue_size:
+            logger.warning(f"Очередь вебхука переполнена ({pending_updates()}), прошу Telegram повторить позже")
+            return web.Response(status=503)
         try:
-            response = client.images.generate(model="dall-e-3", prompt=text, n=1, size="1024x1024", quality="standard")
-            await update.message.reply_photo(photo=response.data[0].url, caption="Ваше изображение готово!")
-        except Exception as e:
-            logger.error(f"Ошибка генерации изображения: {e}")
-            await update.message.reply_text("Не удалось создать изображение.")
-        return
+            update = Update.de_json(await request.json(), application.bot)
+        except ValueError:
+            return web.Response(status=400)
+        if hasattr(update_processor, "reserve"):
+            update_processor.reserve()
+        application.update_queue.put_nowait(update)
+        return web.Response()
+
+    async def health(request):
+        return web.json_response({
+            "status": "ok" if application.running else "starting",
+            "pending_updates": pending_updates(),
+            "in_progress": getattr(update_processor, "in_progress", 0),
+        })
+
+    async def prometheus_metrics(request):
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+    web_app = web.Application()
+    if webhook:
+        web_app.router.add_post(WEBHOOK_PATH, telegram_webhook)
+    web_app.router.add_get("/healthz", health)
+    web_app.router.add_get("/metrics", prometheus_metrics)
+    return web_app
+
+
+async def start_web_server(web_app, host, port):
+    runner = web.AppRunner(web_app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
 
-    # === Логика для режимов чата (Психолог, Астролог, Default) ===
-    history = get_chat_history(chat_id, mode)
-    history.append({"role": "user", "content": text})
-    system_prompts = {
-        "default": "Ты — дружелюбный и полезный ассистент. Используй HTML-теги для форматирования: <b> для жирного, <i> для курсива.",
-        "psychologist": "Ты — эмпатичный психолог. Используй HTML-теги для форматирования: <b> для акцентов, <i> для мягких выделений.",
-        "astrologer": "Ты — опытный астролог. Используй HTML-теги для форматирования: <b> для важных терминов, <i> для названий."
-    }
-    system_prompt = system_prompts.get(mode, system_prompts["default"])
-    messages = [{"role": "system", "content": system_prompt}] + trim_chat_history(history)
-    try:
-        await update.message.chat.send_action(action=ChatAction.TYPING)
-        response = client.chat.completions.create(model="gpt-4o", messages=messages, temperature=0.7, max_tokens=1500)
-        bot_reply = response.choices[0].message.content
-        history.append({"role": "assistant", "content": bot_reply})
-        await update.message.reply_text(bot_reply, parse_mode='HTML', reply_markup=build_keyboard())
-    except Exception as e:
-        logger.error(f"Ошибка ответа OpenAI: {e}")
-        await update.message.reply_text("Произошла ошибка.")
 
 # === Запуск бота ===
-async def main() -> None:
-    await ensure_ffmpeg()
-    application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+def build_application(token=TELEGRAM_BOT_TOKEN, base_url=None, base_file_url=None, backlog_limit=UPDATE_BACKLOG_LIMIT):
+    update_processor = ChatOrderedUpdateProcessor(
+        concurrency=UPDATE_CONCURRENCY,
+        backlog_limit=backlog_limit,
+        backlog_warn=UPDATE_BACKLOG_WARN,
+    )
+    builder = ApplicationBuilder().token(token).concurrent_updates(update_processor)
+    if base_url:
+        builder = builder.base_url(base_url)
+    if base_file_url:
+        builder = builder.base_file_url(base_file_url)
+    application = builder.build()
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(MessageHandler(filters.VOICE, handle_voice))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    metrics.register_gauge("bot_update_backlog", lambda: update_processor.backlog)
+    metrics.register_gauge("bot_updates_in_progress", lambda: update_processor.in_progress)
+    for budget, scheduler in schedulers.items():
+        metrics.register_gauge("bot_scheduler_waiting", lambda scheduler=scheduler: scheduler.waiting, budget=budget)
+    metrics.register_gauge("bot_conversations", lambda: len(conversation_store))
+    metrics.register_gauge("bot_conversation_tokens", lambda: conversation_store.total_tokens)
+    return application
+
+
+async def main() -> None:
+    await ensure_ffmpeg()
+    # В режиме вебхука лишние апдейты отсекаются ответом 503, а не отбрасываются после подтверждения
+    application = build_application(backlog_limit=None if BOT_TRANSPORT == "webhook" else UPDATE_BACKLOG_LIMIT)
+    web_runner = None
+    metrics_task = asyncio.create_task(log_metrics_periodically(METRICS_LOG_INTERVAL))
     try:
         logger.info("Бот запускается...")
         await application.initialize()
         await application.start()
-        await application.updater.start_polling()
+        if BOT_TRANSPORT == "webhook":
+            web_runner = await start_web_server(build_web_app(application), WEBHOOK_HOST, WEBHOOK_PORT)
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+            )
+            logger.info(f"Вебхук слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        else:
+            if METRICS_PORT:
+                web_runner = await start_web_server(build_web_app(application, webhook=False), WEBHOOK_HOST, METRICS_PORT)
+                logger.info(f"Метрики доступны на {WEBHOOK_HOST}:{METRICS_PORT}/metrics")
+            await application.updater.start_polling()
         logger.info("Бот успешно запущен и готов к работе.")
         while True:
             await asyncio.sleep(3600)
     finally:
+        metrics_task.cancel()
+        logger.info(f"Метрики: {metrics.summary()}")
+        if web_runner:
+            await web_runner.cleanup()
         if application.updater and application.updater.running:
             await application.updater.stop()
         if application.running:
             await application.stop()
         await application.shutdown()
+        await openai_gateway.close()
+        await close_http_session()
+        conversation_store.close()
+        response_cache.close()
+        image_cache.close()
+        logger.info(f"Кэш ответов: {response_cache.hits} попаданий, {response_cache.misses} промахов")
         logger.info("Бот успешно остановлен.")
 
 if __name__ == "__main__":